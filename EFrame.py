@@ -37,6 +37,7 @@ import subprocess
 
 from config.kafka import setup
 from core.mainWindow import MainWindow
+from core.metrics import registry as metrics
 from core.exceptions import InitErrorException
 from lib.kafkaLogging import KafkaLoggingHandler
 
@@ -66,6 +67,32 @@ if __name__ == "__main__":
     parser.add_argument("-k", "--no-kafka", action="store_true",
                         dest="nokafka",
                         help="disable Kafka log handler")
+    parser.add_argument("-b", "--buffered-influx", action="store_true",
+                        dest="bufferedInflux",
+                        help="write to InfluxDB in batches from a background "
+                             "thread")
+    parser.add_argument("-p", "--parallel", action="store_true",
+                        dest="parallel",
+                        help="initialize the hardware of modules in "
+                             "parallel, respecting their dependencies")
+    parser.add_argument("-r", "--always-reload", action="store_true",
+                        dest="alwaysReload",
+                        help="reload module code on every import, even if "
+                             "it has not changed (for development)")
+    parser.add_argument("--remote", type=int, dest="remotePort",
+                        help="serve XML-RPC requests to the State on this "
+                             "port")
+    parser.add_argument("--remote-limit", type=int, dest="remoteLimit",
+                        default=4,
+                        help="maximum number of concurrent remote requests "
+                             "per client; all XML-RPC clients on one host "
+                             "count as one client (default: 4)")
+    parser.add_argument("--binary", dest="binaryAddress",
+                        help="serve binary requests to the State on this "
+                             "address (host:port or path of a Unix socket)")
+    parser.add_argument("--status-stream", dest="statusAddress",
+                        help="publish status changes to subscribers on this "
+                             "address (host:port or path of a Unix socket)")
 
     args = parser.parse_args()
 
@@ -165,6 +192,9 @@ if __name__ == "__main__":
         kh.setFormatter(logging.Formatter(fmt=kfmt, datefmt=datefmt))
         kh.setLevel(logging.WARNING)
         logger.addHandler(kh)
+        for key in ("queueDepth", "sent", "spooled", "dropped"):
+            metrics.gauge("logging.kafka.%s" % key,
+                          lambda key=key: kh.stats()[key])
 
     # The log to the output tab in EFrame requires that we have
     # an existing QTextEdit widget available. We therefore wait
@@ -180,4 +210,11 @@ if __name__ == "__main__":
         ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 
     logger.info("Starting EFrame main window")
-    mw = MainWindow(rootLogger=logger, thLevel=thLevel, expFile=expFile)
+    mw = MainWindow(rootLogger=logger, thLevel=thLevel, expFile=expFile,
+                    bufferedInflux=args.bufferedInflux,
+                    parallelStartup=args.parallel,
+                    alwaysReload=args.alwaysReload,
+                    remotePort=args.remotePort,
+                    binaryAddress=args.binaryAddress,
+                    statusAddress=args.statusAddress,
+                    remoteLimit=args.remoteLimit)
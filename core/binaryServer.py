@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Serve remote requests over persistent binary connections.
+
+Scripts which call module methods thousands of times spend most of their
+time opening HTTP connections and encoding XML when using the XML-RPC
+interface. :class:`BinaryServer` accepts persistent TCP or Unix-domain
+socket connections and exchanges msgpack frames (see
+:mod:`lib.binaryProtocol`) instead. Requests are executed by the same
+:class:`~core.remoteServer.RequestExecutor` as XML-RPC requests, i.e.
+resolved through :meth:`~core.state.State._dispatch` and, unless they
+are thread-safe, executed on the GUI thread.
+
+Use :class:`lib.binaryClient.EFrameClient` to connect.
+"""
+import logging
+import os
+import socket
+import threading
+import traceback
+from SocketServer import BaseRequestHandler, ThreadingMixIn, TCPServer
+
+try:
+    from SocketServer import UnixStreamServer
+except ImportError:  # no Unix-domain sockets on Windows
+    UnixStreamServer = None
+
+from lib import binaryProtocol as protocol
+
+
+class _RequestHandler(BaseRequestHandler):
+    def handle(self):
+        server = self.server.owner
+        # request limits apply per connection
+        if self.client_address:
+            client = "%s:%d" % self.client_address[:2]
+        else:
+            client = "local:%x" % id(self)
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.server.address_family == socket.AF_INET:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server.logger.debug("Client %s connected.", client)
+
+        while True:
+            try:
+                request = protocol.receive(self.request)
+            except EOFError:
+                break
+            except protocol.DecodeError as e:
+                # the framing is intact, so the connection can be kept
+                server.logger.warning("Invalid request from %s: %s",
+                                      client, e)
+                response = {"id": None, "error": str(e),
+                            "type": "ProtocolError"}
+            except (socket.error, protocol.ProtocolError) as e:
+                server.logger.warning("Closing connection to %s: %s",
+                                      client, e)
+                break
+            else:
+                response = server.handle(client, request)
+            try:
+                try:
+                    frame = protocol.encode(response)
+                except Exception as e:
+                    server.logger.warning("Cannot encode response to %s: "
+                                          "%s", client, e)
+                    frame = protocol.encode(
+                        {"id": response.get("id"),
+                         "error": "Cannot encode result: %s" % e,
+                         "type": e.__class__.__name__})
+                self.request.sendall(frame)
+            except socket.error as e:
+                server.logger.warning("Failed to respond to %s: %s",
+                                      client, e)
+                break
+
+        server.executor.forget(client)
+        server.logger.debug("Client %s disconnected.", client)
+
+
+class _ThreadedTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if UnixStreamServer is not None:
+    class _ThreadedUnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+
+class BinaryServer(object):
+    """Serve binary requests on *address* through *executor*.
+
+    *address* is either `host:port` or the path of a Unix-domain socket
+    (see :func:`lib.binaryProtocol.parseAddress`).
+    """
+
+    def __init__(self, executor, address):
+        self.logger = logging.getLogger("State.BinaryServer")
+        self.executor = executor
+
+        family, self.address = protocol.parseAddress(address)
+        if family == socket.AF_INET:
+            self.server = _ThreadedTCPServer(self.address, _RequestHandler)
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address)  # left over from a previous run
+            self.server = _ThreadedUnixServer(self.address, _RequestHandler)
+        self.server.owner = self
+        self.thread = None
+
+    def start(self):
+        """Start serving requests on a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="BinaryServer")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Serving binary requests on %s.",
+                         self.server.server_address)
+
+    def stop(self):
+        """Stop serving requests."""
+        if self.thread is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.server.address_family != socket.AF_INET:
+                try:
+                    os.remove(self.address)
+                except OSError:
+                    pass
+            self.thread = None
+            self.logger.info("Stopped serving binary requests.")
+
+    def handle(self, client, request):
+        """Execute *request* and return the response."""
+        try:
+            requestId = request.get("id")
+            method = request["method"]
+            params = request.get("params", [])
+        except (AttributeError, KeyError) as e:
+            return {"id": None, "error": "Malformed request: %s" % e,
+                    "type": "ProtocolError"}
+
+        try:
+            result = self.executor.execute(client, method, params)
+        except Exception as e:
+            self.logger.debug("Request %s from %s failed: %s", method,
+                              client, traceback.format_exc())
+            return {"id": requestId, "error": str(e),
+                    "type": e.__class__.__name__}
+        return {"id": requestId, "result": result}
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""SQLite catalog of the measurement files in the data path.
+
+Every file written through :meth:`~core.storage.Storage.write` (or
+registered with :meth:`~core.storage.Storage.register`) is recorded in
+`catalog.sqlite` in the data path together with its module, timestamp,
+size, columns and the flattened status (see
+:func:`lib.statusEncoder.flatten`), so that measurements can be found
+without opening them:
+
+.. code-block:: python
+
+   from core.catalog import Catalog
+
+   catalog = Catalog("data")
+   runs = catalog.query(module="pmtCounter", start=time.time() - 30 * 86400,
+                        status={"microwave.power": 23})
+
+Files which existed before the catalog (or were written directly by
+modules) are added by rebuilding the catalog, which reads the headers of
+all files in parallel::
+
+    python -m core.catalog data --workers 8
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from lib import data as datalib
+from lib.statusEncoder import flatten
+
+CATALOG_FILE = "catalog.sqlite"
+OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "LIKE")
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS files%(suffix)s (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    module TEXT,
+    timestamp REAL,
+    size INTEGER,
+    columns TEXT
+);
+CREATE TABLE IF NOT EXISTS status%(suffix)s (
+    file INTEGER NOT NULL REFERENCES files%(suffix)s (id),
+    key TEXT NOT NULL,
+    value,
+    PRIMARY KEY (file, key)
+);
+"""
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS files_module ON files (module, timestamp)",
+    "CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp)",
+    "CREATE INDEX IF NOT EXISTS status_key ON status (key, value)")
+REBUILD = "_rebuild"  # suffix of the tables a rebuild is written to
+
+
+def describe(path, dataPath):
+    """Return the catalog entry of the measurement file *path* or `None`.
+
+    The module and timestamp are derived from the location of the file,
+    i.e. `<dataPath>/YYYYMMDD/<module>/YYYYMMDD-HHMMSS[ - name].ext`.
+    """
+    relative = os.path.relpath(path, dataPath).split(os.sep)
+    module = relative[1] if len(relative) == 3 else None
+    timestamp = _timestamp(path)
+
+    if os.path.isdir(path):
+        if not path.endswith(datalib.BINARY_EXTENSION):
+            return None
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        columns = meta["columns"]
+        status = meta["status"]
+        size = sum(os.path.getsize(os.path.join(path, entry))
+                   for entry in os.listdir(path))
+    else:
+        status, count = datalib.loadHeader(path)
+        columns = ["col%d" % i for i in range(count)]
+        size = os.path.getsize(path)
+    return {"path": path, "module": module, "timestamp": timestamp,
+            "size": size, "columns": columns, "status": status}
+
+
+def _timestamp(path):
+    try:
+        return time.mktime(time.strptime(os.path.basename(path)[:15],
+                                         "%Y%m%d-%H%M%S"))
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def _describe(args):
+    try:
+        return describe(*args)
+    except Exception:
+        return None  # not a measurement file
+
+
+def _isScalar(value):
+    return isinstance(value, (basestring, int, long, float, bool))
+
+
+class Catalog(object):
+    """Catalog of the measurement files in *dataPath*.
+
+    If *statusKeys* is given, only status keys starting with one of its
+    entries are recorded. Otherwise, all scalar status values are.
+    *timeout* is the number of seconds to wait if another connection
+    (e.g. a rebuild in another process) is writing to the catalog.
+    """
+
+    def __init__(self, dataPath="data", statusKeys=None, timeout=30.0):
+        self.logger = logging.getLogger("State.Storage.Catalog")
+        self.dataPath = dataPath
+        self.statusKeys = statusKeys
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(dataPath, CATALOG_FILE), timeout=timeout,
+            check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.executescript(TABLES % {"suffix": ""})
+            with self.connection:
+                for statement in INDEXES:
+                    self.connection.execute(statement)
+
+    def _statusRows(self, status):
+        if isinstance(status, basestring):
+            try:
+                status = json.loads(status)
+            except ValueError:
+                return []
+        if not isinstance(status, dict):
+            return []
+        rows = []
+        for key, value in flatten(status).iteritems():
+            if not _isScalar(value):
+                continue
+            if self.statusKeys is not None and not any(
+                    key == prefix or key.startswith(prefix + ".")
+                    for prefix in self.statusKeys):
+                continue
+            rows.append((key, value))
+        return rows
+
+    def _insert(self, entry, suffix=""):
+        self._delete(entry["path"], suffix)
+        cursor = self.connection.execute(
+            "INSERT INTO files%s "
+            "(path, module, timestamp, size, columns) VALUES (?, ?, ?, ?, ?)"
+            % suffix,
+            (entry["path"], entry["module"], entry["timestamp"],
+             entry["size"], json.dumps(entry["columns"])))
+        fileId = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO status%s (file, key, value) VALUES (?, ?, ?)"
+            % suffix,
+            [(fileId, key, value)
+             for key, value in self._statusRows(entry["status"])])
+
+    def add(self, path, module=None, status=None, columns=None,
+            timestamp=None):
+        """Record the measurement file *path*.
+
+        Missing information is derived from the file (see
+        :func:`describe`).
+        """
+        entry = None
+        if module is None or status is None or columns is None:
+            entry = describe(path, self.dataPath)
+        if entry is None:
+            entry = {"path": path, "module": module, "status": status,
+                     "columns": columns, "timestamp": timestamp}
+        else:
+            for key, value in (("module", module), ("status", status),
+                               ("columns", columns),
+                               ("timestamp", timestamp)):
+                if value is not None:
+                    entry[key] = value
+        if entry["timestamp"] is None:
+            entry["timestamp"] = _timestamp(path)
+        if entry.get("size") is None:
+            entry["size"] = os.path.getsize(path)
+
+        with self.lock:
+            with self.connection:
+                self._insert(entry)
+
+    def remove(self, path):
+        """Remove *path* from the catalog."""
+        with self.lock:
+            with self.connection:
+                self._delete(path)
+
+    def _delete(self, path, suffix=""):
+        self.connection.execute("DELETE FROM status%s WHERE file IN "
+                                "(SELECT id FROM files%s WHERE path = ?)"
+                                % (suffix, suffix), (path,))
+        self.connection.execute("DELETE FROM files%s WHERE path = ?" % suffix,
+                                (path,))
+
+    def query(self, module=None, start=None, end=None, status=None,
+              limit=None):
+        """Return the measurement files matching all given criteria.
+
+        *start* and *end* are UNIX timestamps. *status* maps flattened
+        status keys (e.g. `"microwave.power"`) either to a value or to a
+        tuple `(operator, value)`, where *operator* is one of
+        :data:`OPERATORS`.
+
+        Returns a list of dictionaries with the entries `path`, `module`,
+        `timestamp`, `size` and `columns`, sorted by timestamp.
+        """
+        conditions = []
+        params = []
+        if module is not None:
+            conditions.append("module = ?")
+            params.append(module)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp <= ?")
+            params.append(end)
+        for key, value in (status or {}).iteritems():
+            operator = "="
+            if isinstance(value, tuple):
+                operator, value = value
+                if operator.upper() not in OPERATORS:
+                    raise ValueError("Unknown operator '%s'." % operator)
+            conditions.append("id IN (SELECT file FROM status WHERE "
+                              "key = ? AND value %s ?)" % operator)
+            params.extend((key, value))
+
+        sql = "SELECT path, module, timestamp, size, columns FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp"
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        return [{"path": row["path"], "module": row["module"],
+                 "timestamp": row["timestamp"], "size": row["size"],
+                 "columns": json.loads(row["columns"])} for row in rows]
+
+    def status(self, path):
+        """Return the recorded flattened status of *path*."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, value FROM status JOIN files "
+                "ON status.file = files.id WHERE files.path = ?",
+                (path,)).fetchall()
+        return {row["key"]: row["value"] for row in rows}
+
+    def _walk(self):
+        for day in sorted(os.listdir(self.dataPath)):
+            dayPath = os.path.join(self.dataPath, day)
+            if not (day.isdigit() and os.path.isdir(dayPath)):
+                continue
+            for module in sorted(os.listdir(dayPath)):
+                modulePath = os.path.join(dayPath, module)
+                if not os.path.isdir(modulePath):
+                    continue
+                for name in sorted(os.listdir(modulePath)):
+                    if name.endswith((datalib.CACHE_EXTENSION, ".part",
+                                      ".tmp")):
+                        continue
+                    yield os.path.join(modulePath, name)
+
+    def rebuild(self, workers=None):
+        """Index all measurement files in the data path.
+
+        The headers are read by *workers* processes (defaults to the
+        number of CPUs). Returns the number of indexed files.
+
+        The new catalog is written to separate tables in small batches
+        and swapped in at the end, so the catalog stays available while
+        it is rebuilt. Files added in the meantime are kept.
+        """
+        start = time.time()
+        paths = [(path, self.dataPath) for path in self._walk()]
+        with self.lock:
+            self.connection.executescript(
+                "DROP TABLE IF EXISTS status%s; DROP TABLE IF EXISTS files%s;"
+                % (REBUILD, REBUILD) + TABLES % {"suffix": REBUILD})
+
+        pool = multiprocessing.Pool(workers)
+        count = 0
+        batch = []
+        try:
+            for entry in pool.imap_unordered(_describe, paths, chunksize=64):
+                if entry is not None:
+                    batch.append(entry)
+                if len(batch) >= 256:
+                    self._stage(batch)
+                    count += len(batch)
+                    batch = []
+            self._stage(batch)
+            count += len(batch)
+        finally:
+            pool.close()
+            pool.join()
+        self._swap()
+        self.logger.info("Indexed %d of %d files in %.1f s.", count,
+                         len(paths), time.time() - start)
+        return count
+
+    def _stage(self, entries):
+        with self.lock:
+            with self.connection:
+                for entry in entries:
+                    self._insert(entry, REBUILD)
+
+    def _swap(self):
+        with self.lock:
+            # a single transaction including the schema changes
+            isolationLevel = self.connection.isolation_level
+            self.connection.isolation_level = None
+            execute = self.connection.execute
+            try:
+                execute("BEGIN IMMEDIATE")
+                try:
+                    added = execute(
+                        "SELECT id, path, module, timestamp, size, columns "
+                        "FROM files WHERE path NOT IN "
+                        "(SELECT path FROM files%s)" % REBUILD).fetchall()
+                    for row in added:
+                        cursor = execute(
+                            "INSERT INTO files%s (path, module, timestamp, "
+                            "size, columns) VALUES (?, ?, ?, ?, ?)" % REBUILD,
+                            tuple(row)[1:])
+                        execute("INSERT INTO status%s (file, key, value) "
+                                "SELECT ?, key, value FROM status "
+                                "WHERE file = ?" % REBUILD,
+                                (cursor.lastrowid, row["id"]))
+                    execute("DROP TABLE status")
+                    execute("DROP TABLE files")
+                    execute("ALTER TABLE files%s RENAME TO files" % REBUILD)
+                    execute("ALTER TABLE status%s RENAME TO status" % REBUILD)
+                    for statement in INDEXES:
+                        execute(statement)
+                    execute("COMMIT")
+                except Exception:
+                    execute("ROLLBACK")
+                    raise
+            finally:
+                self.connection.isolation_level = isolationLevel
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the catalog of measurement files.")
+    parser.add_argument("dataPath", nargs="?", default="data",
+                        help="data path (default: 'data')")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number "
+                             "of CPUs)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    Catalog(args.dataPath).rebuild(args.workers)
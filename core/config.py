@@ -20,11 +20,88 @@ The configuration for all EFrame modules is stored in a single XML file,
 whose content is parsed and generated by each module (see
 :meth:`modules.baseModule.baseModule.parseConfig` and
 :meth:`~modules.baseModule.baseModule.saveConfig`).
+
+The file is written atomically (through a temporary file which replaces
+the configuration only once it has been written completely) and on a
+background thread, see :meth:`XMLConfig.saveXML`.
 """
+import hashlib
 import logging
+import os
+import threading
+import time
 import xml.etree.ElementTree as ET
-from xml.dom.minidom import parseString as MDParseString
 import traceback
+from xml.sax.saxutils import escape, quoteattr
+
+from journal import ConfigJournal
+from lib import atomicFile
+from metrics import registry as metrics
+
+
+def prettify(element, level=0, indent="\t"):
+    """Serialize *element* with one tag per line, indented by *level*."""
+    lines = []
+    _writeElement(element, level, indent, lines.append)
+    return "".join(lines)
+
+
+def _text(value):
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def _writeElement(element, level, indent, write):
+    prefix = indent * level
+    if element.tag is ET.Comment:
+        write("%s<!--%s-->\n" % (prefix, element.text or ""))
+        return
+
+    tag = element.tag
+    attributes = "".join(" %s=%s" % (key, quoteattr(_text(value)))
+                         for key, value in sorted(element.attrib.items()))
+    text = element.text.strip() if element.text else ""
+    children = list(element)
+    if not children:
+        if text:
+            write("%s<%s%s>%s</%s>\n" % (prefix, tag, attributes,
+                                          escape(text), tag))
+        else:
+            write("%s<%s%s/>\n" % (prefix, tag, attributes))
+        return
+
+    write("%s<%s%s>\n" % (prefix, tag, attributes))
+    if text:
+        write("%s%s%s\n" % (prefix, indent, escape(text)))
+    for child in children:
+        _writeElement(child, level + 1, indent, write)
+        tail = child.tail.strip() if child.tail else ""
+        if tail:
+            write("%s%s%s\n" % (prefix, indent, escape(tail)))
+    write("%s</%s>\n" % (prefix, tag))
+
+
+def _unicode(text):
+    """Decode the serialization *text* of an element.
+
+    Byte strings which are not valid UTF-8 (e.g. Latin-1 attribute values
+    set by modules) are decoded as Latin-1 instead of failing.
+    """
+    if isinstance(text, unicode):
+        return text
+    try:
+        return text.decode("utf-8")
+    except UnicodeDecodeError:
+        return text.decode("latin-1")
+
+
+def _fingerprint(element):
+    """Hash the content of *element* without serializing it."""
+    return hashlib.md5(repr([(child.tag, sorted(child.attrib.items()),
+                              child.text and child.text.strip(),
+                              child.tail and child.tail.strip())
+                             for child in element.iter()])).digest()
 
 
 class XMLConfig:
@@ -36,6 +113,7 @@ class XMLConfig:
         self.currentFileName = None
         self.configTree = None
         self.configRoot = None
+        self._index = {}  # module name -> config element
 
         # WINDOW GEOMETRY
         self.defaultGeometry = (1024, 768, 50, 50)
@@ -43,6 +121,16 @@ class XMLConfig:
 
         # STORAGE
         self.dataPath = "data"
+        self.deduplicateStatus = False
+
+        # SAVING
+        self._fragments = {}  # name -> [configVersion, fingerprint, XML]
+        self._saveThread = None
+        self.lastSaveReport = None
+
+        # JOURNAL
+        self.journal = None
+        self.compactThreshold = 500  # records
 
     def loadXML(self):
         """Load and parse the XML config file for the current configuration."""
@@ -51,6 +139,8 @@ class XMLConfig:
                               "parse XML configuration.")
             return
 
+        self.wait()
+        self._fragments = {}
         self.logger.debug("Loading file '%s.xml'.", self.currentFileName)
         try:
             self.configTree = ET.parse("%s.xml" % self.currentFileName)
@@ -60,14 +150,90 @@ class XMLConfig:
                               "be written to '%s.xml' upon 'Save'.",
                               self.currentFileName, self.currentFileName)
             self.configTree = ET.ElementTree()
+            self.configRoot = None
+            self._index = {}
+            self._replayJournal(0)
+            self._seedFragments()
         except ET.ParseError:
             self.logger.error("Could not parse '%s.xml'.",
                               self.currentFileName)
         else:
             self.configRoot = self.configTree.getroot()
+            self._buildIndex()
+            journalElement = self.configRoot.find("journal")
+            try:
+                sequence = int(journalElement.get("sequence"))
+            except (AttributeError, TypeError, ValueError):
+                sequence = 0
+            self._replayJournal(sequence)
+            self._seedFragments()
             self._loadWindowGeometry()
             self._loadStorageConfiguration()
 
+    def _openJournal(self, sequence=0):
+        path = "%s.journal" % self.currentFileName
+        if self.journal is not None:
+            if self.journal.path == path:
+                return
+            sequence = max(sequence, self.journal.sequence)
+            self.journal.close()
+            self.journal = None
+        try:
+            self.journal = ConfigJournal(path, sequence)
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to open the journal '%s', changes "
+                              "are only kept upon 'Save': %s", path, e)
+
+    def _replayJournal(self, sequence):
+        """Apply all journal records newer than *sequence*."""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self._openJournal(sequence)
+        if self.journal is None:
+            return
+
+        replayed = 0
+        for record in self.journal.read(after=sequence):
+            if record["config"] is None:
+                self._remove(record["module"])
+            else:
+                try:
+                    element = ET.fromstring(record["config"].encode("utf-8"))
+                except ET.ParseError:
+                    self.logger.error("Invalid configuration of '%s' in "
+                                      "journal record %d.", record["module"],
+                                      record["seq"])
+                    continue
+                self._set(record["module"], element)
+            replayed += 1
+        if replayed:
+            self.logger.warning("Restored %d configuration changes which "
+                                "were not saved to '%s.xml' from the "
+                                "journal.", replayed, self.currentFileName)
+
+    def _seedFragments(self):
+        # the configuration of modules which did not change since loading
+        # is neither journaled nor serialized again
+        self._fragments = {}
+        for name, element in self._index.iteritems():
+            self._fragments[name] = [None, _fingerprint(element), None]
+
+    def _buildIndex(self):
+        self._index = {}
+        duplicates = {}
+        for element in self.configRoot.findall("module"):
+            name = element.get("name")
+            if name in self._index:
+                duplicates[name] = duplicates.get(name, 1) + 1
+            else:
+                self._index[name] = element
+        for name, count in duplicates.iteritems():
+            self.logger.warning("%d instances of configuration for module "
+                                "'%s' in XML file, using first and "
+                                "discarding the others upon 'Save'.",
+                                count, name)
+
     def _loadWindowGeometry(self):
         geometryElement = self.configRoot.find("geometry")
         if geometryElement is not None:
@@ -90,16 +256,110 @@ class XMLConfig:
             dataPath = storageElement.get("dataPath")
             if dataPath is not None:
                 self.dataPath = dataPath
+            self.deduplicateStatus = storageElement.get(
+                "deduplicateStatus", "false").lower() == "true"
 
-    def saveXML(self):
-        """Save the XML config file."""
+    def saveXML(self, wait=False):
+        """Save the XML config file.
+
+        The configuration of all modules is collected on the calling (GUI)
+        thread, while the file is written on a background thread. Pass
+        *wait* or call :meth:`wait` to block until the file is written.
+
+        Modules are only serialized if their configuration changed since
+        the last save. Modules which provide a `configVersion` attribute
+        are only asked for their configuration again after they changed
+        their `configVersion`.
+        """
         if self.currentFileName is None:
             self.logger.warning("No experiment loaded, doing nothing.")
             return
 
+        self.wait()  # one save at a time
+        self._openJournal()
+        with metrics.timer("config.save"):
+            content, report = self._serialize()
+
+        self._saveThread = threading.Thread(
+            target=self._write, name="XMLConfig.save",
+            args=("%s.xml" % self.currentFileName, content, report,
+                  self.journal))
+        self._saveThread.start()
+        if wait:
+            self.wait()
+
+    def capture(self):
+        """Append the configuration of all changed modules to the journal.
+
+        Called periodically by the :class:`~core.state.State`. Once the
+        journal has grown to :attr:`compactThreshold` records, the XML
+        file is saved, which compacts the journal.
+        """
+        if self.currentFileName is None:
+            return
+        if self._saveThread is not None and self._saveThread.is_alive():
+            return  # try again later
+
+        start = time.time()
+        self._openJournal()
+        if self.journal is None:
+            return
+        report = {"modules": 0, "skipped": 0, "unchanged": 0,
+                  "serialized": 0, "failed": 0}
+        changed = 0
+        for name in sorted(self.modules):
+            element, fragment, modified = self._saveModule(
+                name, self.modules[name], report)
+            if modified:
+                self._set(name, element)
+                self._journal(name, fragment)
+                changed += 1
+        if changed:
+            self.logger.debug("Captured configuration of %d modules in "
+                              "%.0f ms.", changed, (time.time() - start) * 1000)
+
+        if self.journal.records >= self.compactThreshold:
+            self.logger.debug("Compacting journal with %d records.",
+                              self.journal.records)
+            self.saveXML()
+
+    def _journal(self, name, fragment):
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(name, _unicode(fragment).strip())
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to journal the configuration of '%s': "
+                              "%s", name, e)
+
+    def close(self):
+        """Capture the current configuration and close the journal."""
+        self.capture()
+        self.wait()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def wait(self, timeout=None):
+        """Wait until a running save has been completed."""
+        if self._saveThread is not None:
+            self._saveThread.join(timeout)
+            if not self._saveThread.is_alive():
+                self._saveThread = None
+
+    def _serialize(self):
+        start = time.time()
+        report = {"modules": 0, "skipped": 0, "unchanged": 0,
+                  "serialized": 0, "failed": 0}
+
         oldModules = []
+        others = []
         if self.configRoot is not None:
-            oldModules = self.configRoot.findall('module')
+            for element in self.configRoot:
+                if element.tag == "module":
+                    oldModules.append(element)
+                elif element.tag not in ("geometry", "journal"):
+                    others.append(element)  # e.g. storage configuration
 
         # Create a new root element
         self.configRoot = ET.Element("config")
@@ -111,57 +371,169 @@ class XMLConfig:
         geometryElement.set("x", str(self.x))
         geometryElement.set("y", str(self.y))
         self.configRoot.append(geometryElement)
+        self.configRoot.extend(others)
 
-        for name, module in self.modules.iteritems():
-            try:
-                module.saveConfig()
-            except Exception as e:
-                self.logger.error("Failed to save configuration for module %s",
-                                  name)
-                self.logger.error(traceback.format_exc())
-                continue
+        # Everything up to this record of the journal is part of the file
+        if self.journal is not None:
+            report["sequence"] = self.journal.sequence
+            journalElement = ET.Element("journal")
+            journalElement.set("sequence", str(self.journal.sequence))
+            self.configRoot.append(journalElement)
+        fragments = [prettify(element, 1) for element in self.configRoot]
 
-            try:
-                self.configRoot.append(module.XMLConfig)
-            except ET.ParseError:
-                self.logger.error("ParseError in XMLConfig for module '%s' "
-                                  "at %s, ignoring config.",
-                                  module._name, module)
-
-        self.configTree = ET.ElementTree()
-        self.configTree._setroot(self.configRoot)
+        saved = set()
+        for name in sorted(self.modules):
+            element, fragment, _ = self._saveModule(name, self.modules[name],
+                                                    report)
+            if element is not None:
+                self.configRoot.append(element)
+                fragments.append(fragment)
+                self._index[name] = element
+                saved.add(name)
+        for name in self._fragments.keys():
+            if name not in self.modules:
+                del self._fragments[name]
 
         # Add any old definitions which were not rewritten
-        savedModuleList = [
-            element.get("name") for element in
-            self.configRoot.findall("module")]
         for element in oldModules:
-            if element.get("name") not in savedModuleList:
+            name = element.get("name")
+            if name not in saved and self._index.get(name) is element:
                 self.configRoot.append(element)
+                fragments.append(prettify(element, 1))
 
-        dataString = ET.tostring(self.configRoot)
-        dataString = dataString.replace("\n", "")
-        dataString = dataString.replace("\t", "")
-        xmlOutput = MDParseString(dataString).toprettyxml()
+        self.configTree = ET.ElementTree()
+        self.configTree._setroot(self.configRoot)
+
+        content = u'<?xml version="1.0" encoding="utf-8"?>\n' \
+                  u'<config>\n%s</config>\n' % u"".join(
+                      _unicode(fragment) for fragment in fragments)
+        report["serialize"] = (time.time() - start) * 1000
+        return content.encode("utf-8"), report
 
-        with open("%s.xml" % self.currentFileName, "w") as f:
-            f.write(xmlOutput)
+    def _saveModule(self, name, module, report):
+        """Return the config element of module *name* and its serialization.
+
+        Returns `(None, None, False)` if the module's configuration could
+        not be saved. The last item is `True` if the configuration changed
+        since it was last serialized.
+        """
+        report["modules"] += 1
+        version = getattr(module, "configVersion", None)
+        cached = self._fragments.get(name)
+        if cached is not None and version is not None and cached[0] == version:
+            report["skipped"] += 1
+            return module.XMLConfig, cached[2], False
+
+        try:
+            module.saveConfig()
+            element = module.XMLConfig
+            fingerprint = _fingerprint(element)
+        except Exception:
+            self.logger.error("Failed to save configuration for module %s",
+                              name)
+            self.logger.error(traceback.format_exc())
+            report["failed"] += 1
+            return None, None, False
+
+        if cached is not None and cached[1] == fingerprint:
+            cached[0] = version
+            if cached[2] is None:  # seeded at load
+                cached[2] = prettify(element, 1)
+            report["unchanged"] += 1
+            return element, cached[2], False
+
+        fragment = prettify(element, 1)
+        self._fragments[name] = [version, fingerprint, fragment]
+        report["serialized"] += 1
+        return element, fragment, True
+
+    def _write(self, fileName, content, report, journal):
+        start = time.time()
+        tmpName = "%s.tmp" % fileName
+        try:
+            with open(tmpName, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            atomicFile.replace(tmpName, fileName)
+        except (IOError, OSError) as e:
+            self.logger.error("Failed to write '%s': %s", fileName, e)
+            report["error"] = str(e)
+        else:
+            if journal is not None:
+                try:
+                    journal.compact(report["sequence"])
+                except (IOError, OSError) as e:
+                    self.logger.error("Failed to compact '%s': %s",
+                                      journal.path, e)
+        report["write"] = (time.time() - start) * 1000
+        metrics.histogram("config.write").observe(report["write"])
+        self.lastSaveReport = report
+
+        self.logger.info("Saved configuration of %d modules to '%s' "
+                         "(%d serialized, %d unchanged, %d skipped, %d "
+                         "failed) in %.0f ms + %.0f ms for writing.",
+                         report["modules"], fileName, report["serialized"],
+                         report["unchanged"], report["skipped"],
+                         report["failed"], report["serialize"],
+                         report["write"])
 
     def get(self, module):
         """Return config XML tree for the given module."""
-        self.configRoot = self.configTree.getroot()
-        if self.configRoot is not None:
-            moduleConfig = self.configRoot.findall(
-                "./module[@name='%s']" % (module._name))
-            if not moduleConfig:
-                config = None
-            elif len(moduleConfig) == 1:
-                config = moduleConfig[0]
-            else:
-                self.logger.warning("%d instances of configuration for module "
-                                    "'%s' in XML file, using first.",
-                                    len(moduleConfig), module)
-                config = moduleConfig[0]
-        else:
-            config = None
-        return config
+        return self._index.get(module._name)
+
+    def set(self, name, element):
+        """Replace the configuration of module *name* by *element*."""
+        self._set(name, element)
+        if self.journal is not None:
+            self.journal.append(name, _unicode(prettify(element)).strip())
+
+    def _set(self, name, element):
+        if self.configRoot is None:
+            self.configRoot = ET.Element("config")
+            self.configTree = ET.ElementTree()
+            self.configTree._setroot(self.configRoot)
+        element.set("name", name)
+        previous = self._index.get(name)
+        if previous is None:
+            self.configRoot.append(element)
+        elif previous is not element:
+            children = list(self.configRoot)
+            self.configRoot[children.index(previous)] = element
+        self._index[name] = element
+
+    def unload(self, name):
+        """Keep the configuration of module *name*, which is about to be
+        removed from the state.
+
+        Its current configuration is stored in the index (and journaled if
+        it changed), since only loaded modules are saved. The cached
+        serialization is discarded.
+        """
+        module = self.modules.get(name)
+        if module is not None:
+            report = {"modules": 0, "skipped": 0, "unchanged": 0,
+                      "serialized": 0, "failed": 0}
+            element, fragment, changed = self._saveModule(name, module,
+                                                          report)
+            if changed:
+                self._set(name, element)
+                self._journal(name, fragment)
+        self._fragments.pop(name, None)
+
+    def remove(self, name):
+        """Remove the configuration of module *name*.
+
+        To remove a module from the state, use
+        :meth:`~core.state.State.removeModule`, which keeps its
+        configuration (see :meth:`unload`).
+        """
+        self._remove(name)
+        if self.journal is not None:
+            self.journal.append(name, None)
+
+    def _remove(self, name):
+        element = self._index.pop(name, None)
+        if element is not None:
+            self.configRoot.remove(element)
+        self._fragments.pop(name, None)
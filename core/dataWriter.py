@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Write measurement data on a background thread.
+
+Writing large scans with `np.savetxt` from the GUI thread stalls the
+interface. Instead, modules can pass their data to
+:meth:`~core.storage.Storage.write`, which returns a :class:`WriteHandle`
+immediately and leaves formatting, compression and writing to the
+:class:`DataWriter` thread.
+
+Files are written in the same format as `np.savetxt` with the status as
+header, so they can be read with :func:`lib.data.load`. They are first
+written to a temporary file, which is renamed once its content has been
+synced to disk. To avoid a sync per file, all files written in quick
+succession are synced together.
+
+Files can be compressed with gzip or, if the `zstandard` package is
+installed, with zstd.
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+import numpy as np
+
+from lib import atomicFile
+from lib.statusEncoder import StatusEncoder
+from metrics import registry as metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def encodeStatus(status):
+    """Return *status* as a JSON string, which is not affected by later
+    changes of a status dictionary."""
+    if not status:
+        return None
+    if isinstance(status, basestring):
+        return status
+    return json.dumps(status, cls=StatusEncoder)
+
+
+class WriteHandle(object):
+    """Result of a queued write of the file *path*."""
+
+    def __init__(self, path):
+        self.path = path
+        self.error = None
+        self.queued = time.time()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return `True` once the file has been written (or failed)."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the file has been written.
+
+        Returns `False` if the timeout elapsed first.
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the file to be written and return its path.
+
+        Raises the exception that occurred while writing, if any.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timeout while waiting for '%s'." % self.path)
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+    def addCallback(self, callback):
+        """Call *callback* with this handle once the file has been written.
+
+        The callback is called on the writer thread, or immediately if
+        the file has already been written.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, error=None):
+        self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.getLogger("State.Storage.DataWriter").error(
+                    "Callback for '%s' failed: %s", self.path, e)
+
+
+class _Job(object):
+    def __init__(self, handle, data, status, fmt, delimiter, compression,
+                 statusStore):
+        self.handle = handle
+        self.statusStore = statusStore
+        self.data = data
+        self.status = status
+        self.fmt = fmt
+        self.delimiter = delimiter
+        self.compression = compression
+
+
+class DataWriter(threading.Thread):
+    """Write queued measurements to disk.
+
+    Files written within *syncInterval* seconds of each other, but at most
+    *syncBatch* files, are synced together. Up to *maxQueueSize*
+    measurements are kept in memory; further calls to :meth:`put` block
+    until the writer catches up.
+    """
+
+    def __init__(self, syncInterval=0.5, syncBatch=32, maxQueueSize=256):
+        super(DataWriter, self).__init__(name="DataWriter")
+        self.daemon = True
+        self.logger = logging.getLogger("State.Storage.DataWriter")
+        self.syncInterval = syncInterval
+        self.syncBatch = syncBatch
+        self.queue = Queue.Queue(maxQueueSize)
+
+        self.written = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy = 0.0  # s spent writing
+        self.latency = metrics.histogram("storage.writeLatency")
+        metrics.gauge("storage.queueDepth", self.queue.qsize)
+        metrics.gauge("storage.written", lambda: self.written)
+        metrics.gauge("storage.failed", lambda: self.failed)
+        metrics.gauge("storage.throughput",
+                      lambda: self.stats()["throughput"])
+
+        self._unsynced = []  # [(file, tmpPath, handle)]
+        self._stopped = False
+
+    def put(self, path, data, status=None, fmt="%.18e", delimiter=" ",
+            compression=None, statusStore=None):
+        """Queue *data* with *status* to be written to *path*.
+
+        The extension of the compression is appended to *path*. If a
+        :class:`~lib.statusStore.StatusStore` is passed as *statusStore*,
+        the status is stored there and the header only references it.
+        Returns a :class:`WriteHandle`.
+
+        *data* is copied and a *status* dictionary is encoded right away,
+        so the caller may modify both while the file is being written.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression '%s'." % compression)
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' "
+                             "package.")
+        if self._stopped:
+            raise RuntimeError("DataWriter has been stopped.")
+
+        handle = WriteHandle(path + COMPRESSIONS[compression])
+        self.queue.put(_Job(handle, np.array(data, copy=True),
+                            encodeStatus(status), fmt, delimiter,
+                            compression, statusStore))
+        return handle
+
+    def flush(self, timeout=None):
+        """Wait until all queued measurements are on disk.
+
+        Returns `False` if the timeout elapsed first.
+        """
+        marker = WriteHandle(None)
+        self.queue.put(marker)
+        return marker.wait(timeout)
+
+    def stop(self, timeout=None):
+        """Write all queued measurements and stop the thread."""
+        self._stopped = True
+        self.queue.put(None)
+        self.join(timeout)
+
+    def stats(self):
+        return {"queueDepth": self.queue.qsize(),
+                "written": self.written,
+                "failed": self.failed,
+                "bytes": self.bytes,
+                "throughput": self.bytes / self.busy if self.busy else 0.0}
+
+    def run(self):
+        lastSync = time.time()
+        while True:
+            timeout = None
+            if self._unsynced:
+                timeout = max(0.0, lastSync + self.syncInterval - time.time())
+            try:
+                job = self.queue.get(timeout=timeout)
+            except Queue.Empty:  # sync interval elapsed
+                self._sync()
+                lastSync = time.time()
+                continue
+
+            if job is None:  # stop
+                self._sync()
+                break
+            if isinstance(job, WriteHandle):  # flush
+                self._sync()
+                lastSync = time.time()
+                job._finish()
+                continue
+
+            self._write(job)
+            if len(self._unsynced) >= self.syncBatch:
+                self._sync()
+                lastSync = time.time()
+
+    def _write(self, job):
+        start = time.time()
+        path = job.handle.path
+        tmpPath = "%s.%d.part" % (path, id(job))
+        try:
+            status = job.status
+            if status and job.statusStore is not None:
+                status = job.statusStore.header(status)
+            buf = io.BytesIO()
+            if status is None:
+                np.savetxt(buf, job.data, fmt=job.fmt,
+                           delimiter=job.delimiter)
+            else:
+                np.savetxt(buf, job.data, fmt=job.fmt,
+                           delimiter=job.delimiter, header=status)
+            content = self._compress(buf.getvalue(), job.compression)
+
+            f = open(tmpPath, "wb")
+            try:
+                f.write(content)
+                f.flush()
+            except Exception:
+                f.close()
+                raise
+        except Exception as e:
+            self.logger.error("Failed to write '%s': %s", path, e)
+            self.failed += 1
+            job.handle._finish(e)
+        else:
+            self._unsynced.append((f, tmpPath, job.handle))
+            self.bytes += len(content)
+        self.busy += time.time() - start
+
+    def _compress(self, content, compression):
+        if compression == "gzip":
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(content)
+            return buf.getvalue()
+        if compression == "zstd":
+            return zstandard.ZstdCompressor().compress(content)
+        return content
+
+    def _sync(self):
+        start = time.time()
+        for f, tmpPath, handle in self._unsynced:
+            try:
+                try:
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                atomicFile.replace(tmpPath, handle.path)
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to write '%s': %s", handle.path, e)
+                self.failed += 1
+                handle._finish(e)
+            else:
+                self.written += 1
+                self.latency.observe((time.time() - handle.queued) * 1000)
+                handle._finish()
+        self.busy += time.time() - start
+        self._unsynced = []
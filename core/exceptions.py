@@ -37,3 +37,8 @@ class DataAcquisitionError(EFrameException):
 
 class HardwareError(EFrameException):
     """A request cannot be fulfilled due to hardware problems."""
+
+
+class RemoteRequestError(EFrameException):
+    """A remote request was rejected or could not be completed in time."""
+    pass
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Append-only, indexed history of values, e.g. of module settings.
+
+Keeping a settings history as a pickled list means loading, extending and
+rewriting the complete history for every change. A :class:`HistoryStore`
+instead appends every entry to a log segment and records its timestamp
+and position in an index, so that appending takes constant time and
+:meth:`~HistoryStore.at` and :meth:`~HistoryStore.range` only read the
+entries they return.
+
+A store is a directory (see :meth:`~core.storage.Storage.history`) with
+the files::
+
+    index           timestamp, segment and offset of every entry
+    000001.log      entries (length-prefixed pickles)
+    000002.log
+    ...
+
+A new segment is started once the current one exceeds *segmentSize*
+bytes. When there are more than *maxSegments* segments, all closed
+segments are merged into one on a background thread
+(see :meth:`~HistoryStore.compact`).
+"""
+import bisect
+import cPickle as pickle
+import logging
+import os
+import struct
+import threading
+import time
+
+from lib import atomicFile
+
+ENTRY = struct.Struct(">dI")  # timestamp, length of the pickle
+INDEX = struct.Struct(">dIQ")  # timestamp, segment, offset
+
+
+class HistoryStore(object):
+    """History of values stored in the directory *path*."""
+
+    def __init__(self, path, segmentSize=4 * 1024 * 1024, maxSegments=16,
+                 sync=False):
+        self.logger = logging.getLogger("State.Storage.HistoryStore")
+        self.path = path
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.sync = sync
+        self.lock = threading.RLock()
+        self._compactLock = threading.Lock()  # one compaction at a time
+        self._compacting = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # the index is kept in memory as three parallel lists
+        self.timestamps = []
+        self.segments = []
+        self.offsets = []
+        self._loadIndex()
+        self._finishCompaction()
+        self._recover()
+
+        self._index = open(self._indexPath(), "ab")
+        self._segment = open(self._segmentPath(self._current), "ab")
+        self._segment.seek(0, os.SEEK_END)  # for tell()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _indexPath(self):
+        return os.path.join(self.path, "index")
+
+    def _segmentPath(self, segment):
+        return os.path.join(self.path, "%06d.log" % segment)
+
+    def _segmentNumbers(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def _loadIndex(self):
+        try:
+            with open(self._indexPath(), "rb") as f:
+                content = f.read()
+        except IOError:
+            content = b""
+        complete = len(content) - len(content) % INDEX.size
+        for position in xrange(0, complete, INDEX.size):
+            timestamp, segment, offset = INDEX.unpack_from(content, position)
+            self.timestamps.append(timestamp)
+            self.segments.append(segment)
+            self.offsets.append(offset)
+        if complete != len(content):
+            with open(self._indexPath(), "r+b") as f:
+                f.truncate(complete)
+
+    def _finishCompaction(self):
+        """Complete or undo a compaction which was interrupted by a crash.
+
+        The compaction is complete once the new index has replaced the
+        old one.
+        """
+        names = os.listdir(self.path)
+        pending = [name for name in names if name.endswith(".log.tmp")]
+        if "index.tmp" in names:
+            os.remove(os.path.join(self.path, "index.tmp"))
+            for name in pending:
+                os.remove(os.path.join(self.path, name))
+            return
+        if not pending:
+            return
+        for name in pending:
+            atomicFile.replace(os.path.join(self.path, name),
+                               os.path.join(self.path, name[:-4]))
+        referenced = set(self.segments)
+        segments = self._segmentNumbers()
+        for segment in segments[:-1]:
+            if segment not in referenced:
+                os.remove(self._segmentPath(segment))
+        self.logger.warning("Completed interrupted compaction of '%s'.",
+                            self.path)
+
+    def _recover(self):
+        """Index entries which were written before a crash interrupted
+        the update of the index."""
+        segments = self._segmentNumbers()
+        self._current = segments[-1] if segments else 1
+        if self.segments and self.segments[-1] == self._current:
+            offset = self.offsets[-1]
+            with open(self._segmentPath(self._current), "rb") as f:
+                f.seek(offset)
+                header = f.read(ENTRY.size)
+                offset += ENTRY.size + ENTRY.unpack(header)[1]
+        else:
+            offset = 0
+
+        recovered = []
+        path = self._segmentPath(self._current)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(ENTRY.size)
+                    if len(header) < ENTRY.size:
+                        break
+                    timestamp, length = ENTRY.unpack(header)
+                    if len(f.read(length)) < length:
+                        break
+                    recovered.append((timestamp, self._current, offset))
+                    offset += ENTRY.size + length
+            with open(path, "r+b") as f:
+                f.truncate(offset)  # discard a partially written entry
+
+        if recovered:
+            self.logger.warning("Recovered %d entries of '%s'.",
+                                len(recovered), self.path)
+            with open(self._indexPath(), "ab") as f:
+                for entry in recovered:
+                    f.write(INDEX.pack(*entry))
+                    self.timestamps.append(entry[0])
+                    self.segments.append(entry[1])
+                    self.offsets.append(entry[2])
+
+    def append(self, value, timestamp=None):
+        """Append *value* with *timestamp* (defaults to now).
+
+        Timestamps must not decrease. If the system time was set back, the
+        default timestamp is that of the latest entry. Returns the
+        timestamp.
+        """
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            if timestamp is None:
+                timestamp = time.time()
+                if self.timestamps:
+                    timestamp = max(timestamp, self.timestamps[-1])
+            elif self.timestamps and timestamp < self.timestamps[-1]:
+                raise ValueError("Timestamp %f is older than the latest "
+                                 "entry." % timestamp)
+            offset = self._segment.tell()
+            if offset >= self.segmentSize:
+                self._roll()
+                offset = 0
+            self._segment.write(ENTRY.pack(timestamp, len(payload)))
+            self._segment.write(payload)
+            self._segment.flush()
+            self._index.write(INDEX.pack(timestamp, self._current, offset))
+            self._index.flush()
+            if self.sync:
+                os.fsync(self._segment.fileno())
+                os.fsync(self._index.fileno())
+
+            self.timestamps.append(timestamp)
+            self.segments.append(self._current)
+            self.offsets.append(offset)
+        return timestamp
+
+    def _roll(self):
+        self._segment.close()
+        self._current += 1
+        self._segment = open(self._segmentPath(self._current), "ab")
+        if len(self._segmentNumbers()) > self.maxSegments and \
+                self._compacting is None:
+            self._compacting = threading.Thread(target=self.compact,
+                                                name="HistoryStore.compact")
+            self._compacting.daemon = True
+            self._compacting.start()
+
+    def _read(self, i):
+        with open(self._segmentPath(self.segments[i]), "rb") as f:
+            f.seek(self.offsets[i])
+            timestamp, length = ENTRY.unpack(f.read(ENTRY.size))
+            return pickle.loads(f.read(length))
+
+    def at(self, timestamp, default=None):
+        """Return the value at *timestamp*, i.e. the latest entry which is
+        not newer than *timestamp*, or *default*."""
+        with self.lock:
+            i = bisect.bisect_right(self.timestamps, timestamp) - 1
+            if i < 0:
+                return default
+            return self._read(i)
+
+    def latest(self, default=None):
+        """Return the latest value or *default*."""
+        with self.lock:
+            if not self.timestamps:
+                return default
+            return self._read(len(self.timestamps) - 1)
+
+    def range(self, start=None, end=None):
+        """Return a list of `(timestamp, value)` of all entries from
+        *start* up to and including *end*."""
+        with self.lock:
+            first = 0 if start is None else \
+                bisect.bisect_left(self.timestamps, start)
+            last = len(self.timestamps) if end is None else \
+                bisect.bisect_right(self.timestamps, end)
+            entries = []
+            f = None
+            segment = None
+            try:
+                for i in xrange(first, last):
+                    if segment != self.segments[i]:
+                        if f is not None:
+                            f.close()
+                        segment = self.segments[i]
+                        f = open(self._segmentPath(segment), "rb")
+                    f.seek(self.offsets[i])
+                    timestamp, length = ENTRY.unpack(f.read(ENTRY.size))
+                    entries.append((timestamp, pickle.loads(f.read(length))))
+            finally:
+                if f is not None:
+                    f.close()
+            return entries
+
+    def compact(self):
+        """Merge all closed segments into the first one."""
+        with self._compactLock:
+            self._compact()
+
+    def _compact(self):
+        start = time.time()
+        with self.lock:
+            closed = [segment for segment in self._segmentNumbers()
+                      if segment != self._current]
+        if len(closed) < 2:
+            self._compacting = None
+            return
+
+        target = closed[0]
+        tmpPath = "%s.tmp" % self._segmentPath(target)
+        indexPath = self._indexPath()
+        # marks the compaction as incomplete until the index is replaced
+        open("%s.tmp" % indexPath, "wb").close()
+        moved = {}  # (segment, offset) -> new offset
+        with open(tmpPath, "wb") as out:
+            for segment in closed:
+                with open(self._segmentPath(segment), "rb") as f:
+                    offset = 0
+                    while True:
+                        header = f.read(ENTRY.size)
+                        if len(header) < ENTRY.size:
+                            break
+                        length = ENTRY.unpack(header)[1]
+                        moved[(segment, offset)] = out.tell()
+                        out.write(header)
+                        out.write(f.read(length))
+                        offset += ENTRY.size + length
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self.lock:
+            segments = list(self.segments)
+            offsets = list(self.offsets)
+            for i, (segment, offset) in enumerate(zip(segments, offsets)):
+                if (segment, offset) in moved:
+                    segments[i] = target
+                    offsets[i] = moved[(segment, offset)]
+
+            with open("%s.tmp" % indexPath, "wb") as f:
+                for entry in zip(self.timestamps, segments, offsets):
+                    f.write(INDEX.pack(*entry))
+                f.flush()
+                os.fsync(f.fileno())
+            self._index.close()
+            atomicFile.replace("%s.tmp" % indexPath, indexPath)
+            atomicFile.replace(tmpPath, self._segmentPath(target))
+            self._index = open(indexPath, "ab")
+            self.segments = segments
+            self.offsets = offsets
+            for segment in closed[1:]:
+                os.remove(self._segmentPath(segment))
+            self._compacting = None
+
+        self.logger.debug("Merged %d segments of '%s' in %.0f ms.",
+                          len(closed), self.path, (time.time() - start) * 1000)
+
+    def close(self):
+        with self.lock:
+            self._segment.close()
+            self._index.close()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Append-only journal of changes to the configuration of modules.
+
+Saving the complete XML configuration is too expensive to be done every
+few seconds. Instead, :meth:`~core.config.XMLConfig.capture` appends the
+configuration of every module which changed to a journal next to the
+experiment's `.xml` file. Each line of the journal is a JSON record::
+
+    {"seq": 42, "time": 1500000000.0, "module": "laser",
+     "config": "<module name=\\"laser\\">...</module>"}
+
+where `config` is `null` if the configuration of the module was removed.
+Records are written immediately, but synced to disk at most every
+*syncInterval* seconds.
+
+When the XML file is saved, it stores the sequence number of the last
+record it contains, and all records up to this number are removed from
+the journal (see :meth:`ConfigJournal.compact`). After a crash,
+:meth:`~core.config.XMLConfig.loadXML` replays all newer records.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from lib import atomicFile
+
+
+class ConfigJournal(object):
+    """Journal of module configuration changes stored at *path*."""
+
+    def __init__(self, path, sequence=0, syncInterval=1.0):
+        self.logger = logging.getLogger("State.XMLConfig.ConfigJournal")
+        self.path = path
+        self.syncInterval = syncInterval
+        self.lock = threading.Lock()
+        self.sequence = sequence
+        self.records = 0  # number of records in the file
+        self._file = None
+        self._dirty = False
+        self._closed = threading.Event()
+
+        for record in self.read():
+            self.sequence = max(self.sequence, record["seq"])
+            self.records += 1
+        self._file = open(self.path, "a")
+
+        self._syncThread = threading.Thread(target=self._syncLoop,
+                                            name="ConfigJournal.sync")
+        self._syncThread.daemon = True
+        self._syncThread.start()
+
+    def read(self, after=0):
+        """Yield all records with a sequence number larger than *after*."""
+        try:
+            f = open(self.path, "r")
+        except IOError:
+            return
+        with f:
+            for number, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                    record["seq"], record["module"]
+                except (ValueError, KeyError, TypeError):
+                    # most likely the last record was not written
+                    # completely before a crash
+                    self.logger.warning("Ignoring invalid record in line %d "
+                                        "of '%s'.", number + 1, self.path)
+                    continue
+                if record["seq"] > after:
+                    yield record
+
+    def append(self, name, config):
+        """Record *config* (XML or `None`) as configuration of *name*.
+
+        Returns the sequence number of the record.
+        """
+        with self.lock:
+            self.sequence += 1
+            self._file.write(json.dumps({"seq": self.sequence,
+                                         "time": time.time(),
+                                         "module": name,
+                                         "config": config}) + "\n")
+            self.records += 1
+            self._dirty = True
+            return self.sequence
+
+    def sync(self):
+        """Write all records to disk."""
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self._dirty and self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _syncLoop(self):
+        while not self._closed.wait(self.syncInterval):
+            try:
+                self.sync()
+            except (IOError, OSError) as e:
+                self.logger.error("Failed to sync '%s': %s", self.path, e)
+
+    def compact(self, sequence):
+        """Remove all records up to *sequence* from the journal."""
+        start = time.time()
+        with self.lock:
+            if self._file is None:
+                return
+            self._sync()
+            kept = [json.dumps(record) + "\n"
+                    for record in self.read(after=sequence)]
+            tmpName = "%s.tmp" % self.path
+            with open(tmpName, "w") as f:
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            atomicFile.replace(tmpName, self.path)
+            self._file = open(self.path, "a")
+            removed = self.records - len(kept)
+            self.records = len(kept)
+        self.logger.debug("Removed %d records from '%s' in %.0f ms.",
+                          removed, self.path, (time.time() - start) * 1000)
+
+    def close(self):
+        """Sync and close the journal."""
+        self._closed.set()
+        with self.lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
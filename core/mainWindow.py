@@ -23,6 +23,9 @@ import traceback
 from PyQt4 import QtGui, QtCore
 
 import ui.EFrame_UI as EFrame_UI
+from core.metrics import registry as metrics
+from core.remoteServer import RemoteServer, RequestExecutor
+from core.startup import ParallelStartup
 from core.state import State
 from ui.QTextEditHandler import QTextEditHandler
 
@@ -30,9 +33,12 @@ from ui.QTextEditHandler import QTextEditHandler
 class MainWindow:
     """Display EFrame's main window."""
 
-    def __init__(self, rootLogger, thLevel, expFile):
+    def __init__(self, rootLogger, thLevel, expFile, bufferedInflux=False,
+                 parallelStartup=False, alwaysReload=False, remotePort=None,
+                 binaryAddress=None, statusAddress=None, remoteLimit=4):
         self.experiment = None
         self.logger = logging.getLogger("mainWindow")
+        self.parallelStartup = parallelStartup
 
         self.prepareGUI()
 
@@ -41,9 +47,34 @@ class MainWindow:
         th = QTextEditHandler(self.ui.outputEdit)
         th.setLevel(thLevel)
         rootLogger.addHandler(th)
+        metrics.gauge("logging.gui.pending", lambda: th.stats()["pending"])
+        metrics.gauge("logging.gui.dropped", lambda: th.stats()["dropped"])
 
         # initialize state
-        self.s = State(self.mainWindow)
+        self.s = State(self.mainWindow, bufferedInflux=bufferedInflux,
+                       alwaysReload=alwaysReload)
+
+        # serve remote requests
+        self.remoteServer = None
+        self.binaryServer = None
+        if remotePort is not None or binaryAddress is not None:
+            executor = RequestExecutor(self.s, maxPerClient=remoteLimit)
+            if remotePort is not None:
+                self.remoteServer = RemoteServer(self.s, port=remotePort,
+                                                 executor=executor)
+                self.remoteServer.start()
+            if binaryAddress is not None:
+                # msgpack is only required for the binary interface
+                from core.binaryServer import BinaryServer
+                self.binaryServer = BinaryServer(executor, binaryAddress)
+                self.binaryServer.start()
+
+        # publish status changes
+        self.statusPublisher = None
+        if statusAddress is not None:
+            from core.statusPublisher import StatusPublisher
+            self.statusPublisher = StatusPublisher(self.s, statusAddress)
+            self.statusPublisher.start()
 
         # display main window
         self.mainWindow.closeEvent = self.closeEvent
@@ -73,9 +104,62 @@ class MainWindow:
         self.ui.saveFileButton.clicked.connect(self.saveFile)
         self.ui.runFileButton.clicked.connect(self.runFile)
 
+        self.prepareTimingsDock()
+
+    def prepareTimingsDock(self):
+        """Add a (hidden) dock widget which shows module update timings."""
+        self.timingsDock = QtGui.QDockWidget("Update Timings",
+                                             self.mainWindow)
+        self.timingsDock.setObjectName("UpdateTimingsDock")
+        self.timingsTable = QtGui.QTableWidget(self.timingsDock)
+        self.timingsColumns = ["last", "mean", "max", "interval",
+                               "updates", "skipped"]
+        self.timingsTable.setColumnCount(len(self.timingsColumns))
+        self.timingsTable.setHorizontalHeaderLabels(
+            ["Last (ms)", "Mean (ms)", "Max (ms)", "Interval (ms)",
+             "Updates", "Skipped"])
+        self.timingsTable.setEditTriggers(
+            QtGui.QAbstractItemView.NoEditTriggers)
+        self.timingsDock.setWidget(self.timingsTable)
+        self.mainWindow.addDockWidget(QtCore.Qt.RightDockWidgetArea,
+                                      self.timingsDock)
+        self.timingsDock.hide()
+
+        self.timingsTimer = QtCore.QTimer(self.mainWindow)
+        self.timingsTimer.timeout.connect(self.updateTimingsDock)
+        self.timingsTimer.start(1000)
+
+    def updateTimingsDock(self):
+        if not self.timingsDock.isVisible():
+            return
+        timings = self.s.getUpdateTimings()
+        names = sorted(timings, key=lambda name: timings[name]["mean"],
+                       reverse=True)
+        self.timingsTable.setRowCount(len(names))
+        self.timingsTable.setVerticalHeaderLabels(names)
+        for row, name in enumerate(names):
+            for column, key in enumerate(self.timingsColumns):
+                value = timings[name][key]
+                if isinstance(value, float):
+                    text = "%.1f" % value
+                else:
+                    text = "%d" % value
+                self.timingsTable.setItem(row, column,
+                                          QtGui.QTableWidgetItem(text))
+
     def closeEvent(self, event):
         self.stopUpdate()
+        if self.remoteServer is not None:
+            self.remoteServer.stop()
+        if self.binaryServer is not None:
+            self.binaryServer.stop()
+        if self.statusPublisher is not None:
+            self.statusPublisher.stop()
+        # removing a module journals its configuration, so the journal is
+        # only closed afterwards
         self.s.removeAllModules()
+        self.s.config.close()
+        self.s.influx.close()
 
     def startUpdate(self):
         if self.running:
@@ -215,7 +299,8 @@ class MainWindow:
                 self.logger.warning("No window state found for configuration"
                                     "'%s'.", fileName)
             else:
-                self.mainWindow.restoreState(data)
+                with self.s.profiler.phase("mainWindow", "loadWindowState"):
+                    self.mainWindow.restoreState(data)
                 self.logger.info("Loaded window state from '%s'.", fileName)
         self.s.loadingCompleted.emit()
         self.startUpdate()
@@ -250,15 +335,29 @@ class MainWindow:
 
         try:
             with open(fileName, "r") as config:
-                toBeLoaded = [line.strip() for line in config
-                              if not line.strip()[0] == "#"]
+                entries = [line.strip() for line in config
+                           if line.strip() and not line.strip()[0] == "#"]
         except IOError:
             self.logger.error("Cannot read file %s.", fileName)
             return
 
+        # modules can list the modules they depend on after a colon
+        toBeLoaded = []
+        dependencies = {}
+        for entry in entries:
+            moduleName, _, required = entry.partition(":")
+            moduleName = moduleName.strip()
+            toBeLoaded.append(moduleName)
+            dependencies[moduleName] = [dependency.strip() for dependency
+                                        in required.split(",")
+                                        if dependency.strip()]
+
+        self.s.profiler.reset()
         self.logger.info("Loading XML configuration file.")
         self.s.config.currentFileName = fileName
-        self.s.config.loadXML()
+        with self.s.profiler.phase("State", "loadXML"):
+            self.s.config.loadXML()
+        self.s.store.deduplicateStatus = self.s.config.deduplicateStatus
 
         self.logger.debug("Restoring window geometry and position.")
         self.mainWindow.resize(self.s.config.width, self.s.config.height)
@@ -266,20 +365,23 @@ class MainWindow:
 
         self.logger.info("Loading %d modules.", len(toBeLoaded))
         try:
-            for moduleName in toBeLoaded:
-                if self.s.loaded(moduleName):
-                    # this can happen through baseModule.requiresModule()
-                    self.logger.debug("Module %s is already loaded.",
-                                      moduleName)
-                else:
-                    self.s.addModule(moduleName)
+            if self.parallelStartup:
+                ParallelStartup(self.s, self.app).run(toBeLoaded,
+                                                      dependencies)
+            else:
+                for moduleName in toBeLoaded:
+                    if self.s.loaded(moduleName):
+                        # this can happen through baseModule.requiresModule()
+                        self.logger.debug("Module %s is already loaded.",
+                                          moduleName)
+                    else:
+                        self.s.addModule(moduleName)
         except Exception as e:
             self.logger.error("Caught exception during initialization: "
                               "'%s: %s'.",
                               e.__class__.__name__, e.message)
             self.logger.error("%s", traceback.format_exc())
 
-
         self.logger.debug("Restoring window state.")
         # TB: This does not work properly if it is done directly, but
         # calling it in a single shot timer seems to fix this
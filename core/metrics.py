@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Runtime performance metrics for EFrame.
+
+Like loggers, metrics are registered by name in a process-wide
+:class:`Registry`, which is available as :data:`registry`:
+
+.. code-block:: python
+
+   from core.metrics import registry
+
+   registry.counter("pmtCounter.photons").inc(counts)
+   with registry.timer("pmtCounter.readout"):
+       self.readout()
+
+Three types of metrics are supported:
+
+* :class:`Counter`: a monotonically increasing count
+* :class:`Gauge`: a value which is set explicitly or read from a function
+* :class:`Histogram`: a distribution of values, typically durations in ms
+
+The :class:`~core.state.State` periodically writes all metrics to InfluxDB
+in a single batch and makes them available to remote clients through
+:meth:`~core.state.State.getMetrics`.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Counter(object):
+    """A monotonically increasing count."""
+    type_ = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Gauge(object):
+    """A value which is either set or read from *function* when needed."""
+    type_ = "gauge"
+
+    def __init__(self, function=None):
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is not None:
+            self.value = self.function()
+        return {"value": self.value}
+
+
+class Histogram(object):
+    """A distribution of values, e.g. durations in ms.
+
+    Values are counted in buckets with the upper bounds *buckets*.
+    Percentiles are estimated from the buckets.
+    """
+    type_ = "histogram"
+    defaultBuckets = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500,
+                      1000, 2000, 5000, 10000)
+
+    def __init__(self, buckets=None):
+        self.lock = threading.Lock()
+        self.buckets = list(buckets or self.defaultBuckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            self.last = value
+
+    def percentile(self, fraction):
+        """Estimate the *fraction* percentile (upper bucket bound)."""
+        with self.lock:
+            target = fraction * self.count
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                if cumulative >= target:
+                    return min(bound, self.max)
+            return self.max
+
+    def snapshot(self):
+        with self.lock:
+            count = self.count
+            total = self.sum
+            maximum = self.max
+            last = self.last
+        return {"count": count,
+                "sum": total,
+                "mean": total / count if count else 0.0,
+                "max": maximum,
+                "last": last,
+                "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95)}
+
+
+class Registry(object):
+    """Keep track of all metrics by name."""
+
+    def __init__(self):
+        self.logger = logging.getLogger("Metrics")
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, name, cls, *args):
+        with self.lock:
+            try:
+                metric = self.metrics[name]
+            except KeyError:
+                metric = self.metrics[name] = cls(*args)
+        if not isinstance(metric, cls):
+            raise TypeError("Metric '%s' is a %s, not a %s."
+                            % (name, metric.type_, cls.type_))
+        return metric
+
+    def counter(self, name):
+        """Return the :class:`Counter` *name*, creating it if necessary."""
+        return self._get(name, Counter)
+
+    def gauge(self, name, function=None):
+        """Return the :class:`Gauge` *name*, creating it if necessary.
+
+        If *function* is given, the gauge's value is read from it.
+        """
+        gauge = self._get(name, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, buckets=None):
+        """Return the :class:`Histogram` *name*, creating it if necessary."""
+        return self._get(name, Histogram, buckets)
+
+    @contextmanager
+    def timer(self, name):
+        """Record the duration (in ms) of the enclosed block in *name*."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe((time.time() - start) * 1000)
+
+    def remove(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def snapshot(self):
+        """Return a dictionary of the current values of all metrics."""
+        with self.lock:
+            metrics = self.metrics.items()
+        snapshot = {}
+        for name, metric in metrics:
+            try:
+                snapshot[name] = metric.snapshot()
+            except Exception as e:
+                self.logger.debug("Failed to read metric '%s': %s", name, e)
+            else:
+                snapshot[name]["type"] = metric.type_
+        return snapshot
+
+    def points(self):
+        """Return all metrics as a list of InfluxDB points."""
+        points = []
+        for name, values in self.snapshot().iteritems():
+            type_ = values.pop("type")
+            fields = {key: float(value) for key, value in values.iteritems()
+                      if isinstance(value, (int, long, float))}
+            if fields:
+                points.append({"measurement": "metrics",
+                               "tags": {"metric": name, "type": type_},
+                               "fields": fields})
+        return points
+
+
+registry = Registry()
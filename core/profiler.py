@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Find out which module slows down the loading of an experiment.
+
+:class:`StartupProfiler` records how long each module spends in each
+phase of its startup:
+
+* **import**: first import of the module's code
+* **reload**: reload of the module's code
+* **instantiate**: construction of the module (includes *parseConfig*)
+* **parseConfig**: parsing of the module's XML configuration
+* **initHardware**: initialization of the module's hardware connections
+* **firstUpdate**: first GUI update after loading has completed
+
+Phases which do not belong to a single module, such as loading the XML
+configuration or restoring the window state, are recorded under the name
+of the component (e.g. `State` or `mainWindow`).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class StartupProfiler(object):
+    """Record the duration of startup phases per module."""
+
+    def __init__(self):
+        self.logger = logging.getLogger("State.StartupProfiler")
+        self.lock = threading.Lock()
+        self.timings = {}  # name -> {phase: duration in s}
+        self.started = time.time()
+        self.lastReport = None
+
+    def reset(self):
+        """Discard all timings and restart the clock."""
+        with self.lock:
+            self.timings = {}
+            self.started = time.time()
+
+    def record(self, name, phase, duration):
+        """Add *duration* (in s) to *phase* of *name*."""
+        with self.lock:
+            phases = self.timings.setdefault(name, {})
+            phases[phase] = phases.get(phase, 0.0) + duration
+
+    @contextmanager
+    def phase(self, name, phase):
+        """Time the enclosed block as *phase* of *name*."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, phase, time.time() - start)
+
+    def instrument(self, moduleClass, name, method="parseConfig"):
+        """Time calls to *method* of *moduleClass* as a phase of *name*."""
+        original = getattr(moduleClass, method, None)
+        if original is None or getattr(original, "_profiled", False):
+            return
+
+        profiler = self
+
+        @wraps(original)
+        def timed(*args, **kwargs):
+            with profiler.phase(name, method):
+                return original(*args, **kwargs)
+
+        timed._profiled = True
+        setattr(moduleClass, method, timed)
+
+    def report(self):
+        """Return a dictionary with all timings and the total duration."""
+        with self.lock:
+            modules = {name: dict(phases)
+                       for name, phases in self.timings.iteritems()}
+            total = time.time() - self.started
+        slowest = sorted(modules, key=lambda name: sum(modules[name].values()),
+                         reverse=True)
+        return {"started": self.started,
+                "total": total,
+                "modules": modules,
+                "slowest": slowest}
+
+    def finish(self, influx=None, path="log"):
+        """Compile the report, log a summary, and write it to *path*.
+
+        If an :class:`~lib.influx.Influx` instance is passed as *influx*,
+        the timings are also written to InfluxDB.
+        Returns the report.
+        """
+        report = self.report()
+        if not report["modules"]:
+            return report
+        self.lastReport = report
+
+        self.logger.info("Startup took %.1f s.", report["total"])
+        for name in report["slowest"][:5]:
+            phases = report["modules"][name]
+            self.logger.info("%s: %.2f s (%s)", name, sum(phases.values()),
+                             ", ".join("%s: %.2f s" % item for item
+                                       in sorted(phases.iteritems())))
+
+        fileName = os.path.join(path, "startup-%s.json" % time.strftime(
+            "%Y%m%d-%H%M%S", time.localtime(report["started"])))
+        try:
+            with open(fileName, "w") as f:
+                json.dump(report, f, indent=4)
+        except IOError:
+            self.logger.error("Failed to write '%s'.", fileName)
+        else:
+            self.logger.debug("Wrote startup report to '%s'.", fileName)
+
+        if influx is not None:
+            points = [{"measurement": "startup",
+                       "fields": {"duration": duration},
+                       "tags": {"module": name, "phase": phase}}
+                      for name, phases in report["modules"].iteritems()
+                      for phase, duration in phases.iteritems()]
+            try:
+                influx.write(points)
+            except Exception as e:
+                self.logger.error("Failed to write startup report to "
+                                  "InfluxDB: %s", e)
+        return report
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Serve remote requests to the :class:`~core.state.State` concurrently.
+
+:class:`RemoteServer` is an XML-RPC server which handles every request on
+its own thread and dispatches it through
+:meth:`~core.state.State._dispatch`. Requests to methods which are
+thread-safe (see :meth:`~core.state.State.isThreadSafe`) are executed
+directly on that thread, so read-only queries such as `getMetrics` never
+wait for other requests. All other requests are marshalled to the GUI
+thread through a :class:`GUIInvoker` and executed there one at a time.
+
+Requests are executed by a :class:`RequestExecutor`, which can be shared
+with other transports (see :mod:`core.binaryServer`). Each client can have
+at most *maxPerClient* requests in progress, further requests wait for one
+of them to finish. Requests which wait longer than *timeout* seconds for
+this or for the GUI thread fail with a
+:class:`~core.exceptions.RemoteRequestError`.
+"""
+import logging
+import threading
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+from PyQt4 import QtCore
+
+from core.exceptions import RemoteRequestError
+
+
+class _Job(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class _Slots(object):
+    """Counting semaphore whose :meth:`acquire` takes a timeout, which
+    :class:`threading.Semaphore` does not in Python 2."""
+
+    def __init__(self, count):
+        self.free = count
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout):
+        """Take a slot, waiting up to *timeout* seconds for one to become
+        free. Returns `False` if none became free."""
+        clock = QtCore.QElapsedTimer()  # monotonic
+        clock.start()
+        with self.condition:
+            while not self.free:
+                remaining = timeout - clock.elapsed() / 1000.0
+                if remaining <= 0:
+                    return False
+                # Condition.wait() uses the system time in Python 2
+                self.condition.wait(min(remaining, 1.0))
+            self.free -= 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.free += 1
+            self.condition.notify()
+
+
+class GUIInvoker(QtCore.QObject):
+    """Execute callables on the GUI thread and wait for their result.
+
+    Needs to be instantiated on the GUI thread.
+    """
+    _invoke = QtCore.pyqtSignal(object)
+
+    def __init__(self):
+        super(GUIInvoker, self).__init__()
+        self._invoke.connect(self._run)
+
+    def call(self, func, args=(), timeout=None):
+        """Call *func* with *args* on the GUI thread and return the result.
+
+        Raises :class:`~core.exceptions.RemoteRequestError` if the call
+        did not complete within *timeout* seconds.
+        """
+        if QtCore.QThread.currentThread() == self.thread():
+            return func(*args)
+
+        job = _Job(func, args)
+        self._invoke.emit(job)  # queued to the GUI thread
+        if not job.done.wait(timeout):
+            job.cancelled = True
+            raise RemoteRequestError("Timeout after %s s while waiting for "
+                                     "the GUI thread." % timeout)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, job):
+        if job.cancelled:
+            return
+        try:
+            job.result = job.func(*job.args)
+        except Exception as e:
+            job.error = e
+        finally:
+            job.done.set()
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+    def do_POST(self):
+        # make the client's address available to the dispatcher
+        self.server.clients.address = self.client_address[0]
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class _ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RequestExecutor(object):
+    """Execute remote requests to *state* on the appropriate thread.
+
+    Each client can have at most *maxPerClient* requests in progress,
+    further requests wait up to *timeout* seconds before they are rejected.
+    XML-RPC clients are identified by their IP address, as every request
+    uses a new connection, so all XML-RPC clients on the same host share
+    their limit (e.g. all local scripts). Binary clients are identified
+    by their connection. Needs to be instantiated on the GUI thread.
+    """
+
+    def __init__(self, state, maxPerClient=4, timeout=30.0):
+        self.logger = logging.getLogger("State.RequestExecutor")
+        self.s = state
+        self.maxPerClient = maxPerClient
+        self.timeout = timeout
+        self.invoker = GUIInvoker()
+
+        self.clientLock = threading.Lock()
+        self.clientSlots = {}  # client -> _Slots
+
+    def _slots(self, client):
+        with self.clientLock:
+            try:
+                return self.clientSlots[client]
+            except KeyError:
+                slots = _Slots(self.maxPerClient)
+                self.clientSlots[client] = slots
+                return slots
+
+    def forget(self, client):
+        """Discard the request slots of *client*, e.g. once its connection
+        was closed."""
+        with self.clientLock:
+            self.clientSlots.pop(client, None)
+
+    def execute(self, client, method, params):
+        """Dispatch *method* with *params* on behalf of *client*."""
+        slots = self._slots(client)
+        if not slots.acquire(self.timeout):
+            self.logger.warning("Rejected request %s from %s: too many "
+                                "concurrent requests.", method, client)
+            raise RemoteRequestError("Too many concurrent requests from %s "
+                                     "(at most %d)." % (client,
+                                                        self.maxPerClient))
+        try:
+            if self._isThreadSafe(method, params):
+                return self.s._dispatch(method, params)
+            return self.invoker.call(self.s._dispatch, (method, params),
+                                     self.timeout)
+        finally:
+            slots.release()
+
+    def _isThreadSafe(self, method, params):
+        if method in ("multicall", "system.multicall"):
+            try:
+                return all(self.s.isThreadSafe(
+                    call["methodName"] if isinstance(call, dict) else call[0])
+                    for call in params[0])
+            except (IndexError, KeyError, TypeError):
+                return False
+        return self.s.isThreadSafe(method)
+
+
+class RemoteServer(object):
+    """Serve XML-RPC requests to *state* on *host*:*port*.
+
+    Requests are executed through *executor*, a :class:`RequestExecutor`
+    which is created if not given. Needs to be instantiated on the GUI
+    thread.
+    """
+
+    def __init__(self, state, host="", port=8000, executor=None,
+                 maxPerClient=4, timeout=30.0):
+        self.logger = logging.getLogger("State.RemoteServer")
+        if executor is None:
+            executor = RequestExecutor(state, maxPerClient, timeout)
+        self.executor = executor
+
+        self.server = _ThreadedXMLRPCServer((host, port),
+                                            requestHandler=_RequestHandler,
+                                            logRequests=False,
+                                            allow_none=True)
+        self.server.clients = threading.local()
+        self.server.register_instance(self)
+        self.thread = None
+
+    def start(self):
+        """Start serving requests on a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="RemoteServer")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Serving remote requests on %s:%d.",
+                         *self.server.server_address)
+
+    def stop(self):
+        """Stop serving requests."""
+        if self.thread is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread = None
+            self.logger.info("Stopped serving remote requests.")
+
+    def _dispatch(self, method, params):
+        client = getattr(self.server.clients, "address", None)
+        return self.executor.execute(client, method, params)
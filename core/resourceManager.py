@@ -20,11 +20,67 @@ import logging
 import threading
 from PyQt4 import QtCore
 
+from metrics import registry as metrics
+
+
+def _elapsed(clock):
+    """Return the time in s since the :class:`QtCore.QElapsedTimer`
+    *clock* was started."""
+    return clock.nsecsElapsed() * 1e-9
+
+
+class _Request(object):
+    """A claim or release request to a number of modules."""
+
+    def __init__(self, kind, modules, owner=None, event=None):
+        self.kind = kind
+        self.modules = list(modules)
+        self.owner = owner
+        self.pending = set(self.modules)
+        self.events = {}
+        self.succeeded = []
+        self.failed = []
+        self.unresponsive = []
+        self.event = event if event is not None else threading.Event()
+        self.event.clear()
+
 
 class Resources(QtCore.QObject):
+    """Claim and release the hardware resources of modules.
+
+    Modules respond to :meth:`claim` and :meth:`release` by setting the
+    :class:`threading.Event` returned from their `claimResources()` and
+    `releaseResources()` methods. For every request, a watcher thread waits
+    for these events one after the other and reports the responses back to
+    the GUI thread, so a request completes as soon as the last module
+    responds.
+
+    A module which does not respond within its timeout is considered to
+    have failed. The timeouts default to :attr:`defaultTimeout` and can be
+    set per module through :attr:`timeouts` (keyed by module name) or
+    the module attributes `claimTimeout` and `releaseTimeout` (in s).
+    Timeouts are measured with a monotonic clock, so adjusting the system
+    time does not cut them short or stretch them. The latency of the most
+    recent claim and release of every module is available through
+    :attr:`latencies`. It is measured when the watcher notices the
+    response, which may be after slower modules of the same request
+    responded.
+
+    By default, requests go to all modules. Requests can also be limited to
+    a list of module names or names of groups defined through
+    :meth:`defineGroup`. Requests for disjoint sets of modules run
+    concurrently. If a claim fails, only the modules which were
+    successfully claimed are released again. Who claimed which module is
+    available through :meth:`ownership`.
+    """
 
     claim_signal = QtCore.pyqtSignal()
     release_signal = QtCore.pyqtSignal()
+    _claimModules = QtCore.pyqtSignal(object, object)
+    _releaseModules = QtCore.pyqtSignal(object)
+    _responded = QtCore.pyqtSignal(object, object, bool, float)
+
+    defaultTimeout = 5.0  # s
 
     def __init__(self, modules):
         super(Resources, self).__init__()
@@ -36,27 +92,62 @@ class Resources(QtCore.QObject):
         self.claimed = False
         self.remoteClaimRequested = False
         self.remoteReleaseRequested = False
-        self.responseCounter = 0
-        self.releasedEvents = {}
-        self.unclaimedModules = []
-        self.claimedResponses = {}
+        self.requests = set()
+        self.busy = {}  # name -> request
+        self.owners = {}  # name -> owner
+        self.groups = {}  # name -> [module names]
+        self.timeouts = {}  # name -> s
+        self.latencies = {}  # name -> {"claim": s, "release": s}
 
         self.claim_signal.connect(self.claim)
         self.release_signal.connect(self.release)
+        self._claimModules.connect(self.claim)
+        self._releaseModules.connect(self.release)
+        self._responded.connect(self._onResponse)
+
+    def areClaimed(self, modules=None, owner=None):
+        """Check whether all *modules* (by default: all) are claimed.
 
-    def areClaimed(self):
-        return self.claimed
+        If *owner* is given, the modules need to be claimed by *owner*.
+        """
+        if modules is None and owner is None:
+            return self.claimed
+        names = self._names(modules)
+        if owner is None:
+            return all(name in self.owners for name in names)
+        return all(self.owners.get(name) == owner for name in names)
 
     def isClaiming(self):
         return self.claiming
 
+    def ownership(self):
+        """Return a dictionary of the owner of every module's resources.
+
+        Modules whose resources are not claimed have the owner `""`.
+        """
+        return {name: self.owners.get(name, "") for name in self.modules}
+
+    def defineGroup(self, name, modules):
+        """Define a group *name* of *modules* to claim and release together."""
+        if name in self.modules:
+            self.logger.warning("Group '%s' shadows module '%s'.",
+                                name, name)
+        self.groups[name] = list(modules)
+
+    def removeGroup(self, name):
+        self.groups.pop(name, None)
+
     def remoteClaimRequestHandled(self):
         return not self.remoteClaimRequested
 
     def remoteReleaseRequestHandled(self):
         return not self.remoteReleaseRequested
 
-    def remoteClaim(self):
+    def remoteClaim(self, modules=None, owner="remote"):
+        if modules is not None:
+            self._claimModules.emit(modules, owner)
+            return
+
         if self.remoteClaimRequested:
             self.logger.warning(
                 "Received request for remoteClaim while previous request "
@@ -66,7 +157,11 @@ class Resources(QtCore.QObject):
 
         self.claim_signal.emit()
 
-    def remoteRelease(self):
+    def remoteRelease(self, modules=None):
+        if modules is not None:
+            self._releaseModules.emit(modules)
+            return
+
         if self.remoteReleaseRequested:
             self.logger.warning(
                 "Received request for remoteRelease while previous request "
@@ -76,162 +171,219 @@ class Resources(QtCore.QObject):
 
         self.release_signal.emit()
 
-    def claim(self):
+    def timeout(self, module, kind):
+        """Return the timeout (in s) for a *kind* request to *module*."""
+        try:
+            return self.timeouts[module._name]
+        except KeyError:
+            return getattr(module, "%sTimeout" % kind, self.defaultTimeout)
+
+    def _names(self, modules):
+        """Resolve a list of module and group names to module names."""
+        if modules is None:
+            return list(self.modules)
+        if isinstance(modules, basestring):
+            modules = [modules]
+        names = []
+        for name in modules:
+            for member in self.groups.get(name, [name]):
+                if member not in self.modules:
+                    self.logger.warning("No module '%s' loaded.", member)
+                elif member not in names:
+                    names.append(member)
+        return names
+
+    def forget(self, name):
+        """Discard the ownership of module *name*, e.g. once it has been
+        removed."""
+        self.owners.pop(name, None)
+        self.latencies.pop(name, None)
+        self._updateFlags()
+
+    def _updateFlags(self):
+        self.claiming = bool(self.requests)
+        self.claimed = bool(self.modules) and \
+            all(name in self.owners for name in self.modules)
+
+    def _start(self, kind, names, owner=None, event=None):
+        request = _Request(kind, [self.modules[name] for name in names],
+                           owner, event)
+        self.requests.add(request)
+        for name in names:
+            self.busy[name] = request
+        self._updateFlags()
+
+        self.logger.debug("Requesting %s of %s.", kind, names)
+        clock = QtCore.QElapsedTimer()  # monotonic
+        clock.start()
+        waiting = []  # [(deadline, module, event, start)]
+        for module in request.modules:
+            start = _elapsed(clock)
+            if kind == "claim":
+                event = module.claimResources()
+            else:
+                event = module.releaseResources()
+            request.events[module] = event
+            waiting.append((start + self.timeout(module, kind), module,
+                            event, start))
+        if not request.modules:
+            self._finish(request)
+        else:
+            watcher = threading.Thread(target=self._waitForResponses,
+                                       args=(request, clock, waiting),
+                                       name="Resources.%s" % kind)
+            watcher.daemon = True
+            watcher.start()
+        return request
+
+    def _waitForResponses(self, request, clock, waiting):
+        # the request is complete once the last module responded, so it
+        # does not matter in which order the responses are noticed
+        waiting.sort(key=lambda entry: entry[0])
+        for deadline, module, event, start in waiting:
+            # Event.wait() uses the system time in Python 2, so a single
+            # wait is kept short
+            remaining = deadline - _elapsed(clock)
+            while remaining > 0 and not event.wait(min(remaining, 1.0)):
+                remaining = deadline - _elapsed(clock)
+            # queued to the GUI thread
+            self._responded.emit(request, module, not event.isSet(),
+                                 _elapsed(clock) - start)
+
+    def _onResponse(self, request, module, timedOut, latency):
+        if module not in request.pending:
+            return
+        request.pending.discard(module)
+        self.latencies.setdefault(module._name, {})[request.kind] = latency
+        metrics.histogram("resources.%s" % request.kind).observe(
+            latency * 1000)
+        self.logger.debug("%s responded to %s request after %.3f s.",
+                          module._name, request.kind, latency)
+
+        if timedOut:
+            metrics.counter("resources.timeouts").inc()
+            request.unresponsive.append(module)
+            request.events[module].set()  # signal the module to stop trying
+        elif request.kind == "claim" and not module.claimed:
+            self.logger.warning("Could not claim %s", module._name)
+            self.logger.debug("Module instance: %s", module)
+            request.failed.append(module)
+        else:
+            request.succeeded.append(module)
+
+        if not request.pending:
+            self._finish(request)
+
+    def _finish(self, request):
+        self.requests.discard(request)
+        for module in request.modules:
+            if self.busy.get(module._name) is request:
+                del self.busy[module._name]
+
+        if request.unresponsive:
+            self.logger.error("Modules did not respond to %s within their "
+                              "timeout: %s", request.kind,
+                              [module._name for module
+                               in request.unresponsive])
+
+        if request.kind == "claim":
+            for module in request.succeeded:
+                self.owners[module._name] = request.owner
+            unclaimedModules = request.failed + request.unresponsive
+            self.logger.info("All modules responded to claim.")
+            self.logger.info("Unclaimed: %s", [module._name for module
+                                               in unclaimedModules])
+            self._updateFlags()
+            request.event.set()
+            if unclaimedModules:
+                self._releaseAfterUnsuccesfulClaim(request)
+            else:
+                self.logger.info("Successfully claimed %s.",
+                                 [module._name for module in request.modules])
+        else:
+            for module in request.modules:
+                self.owners.pop(module._name, None)
+            self._updateFlags()
+            request.event.set()  # unfreeze the calling module
+            self.logger.debug("Released resources.")
+
+    def claim(self, modules=None, owner="local"):
+        """Claim the hardware resources of *modules* for *owner*.
+
+        *modules* is a list of module and group names and defaults to all
+        modules. Returns a :class:`threading.Event` which is set once all
+        modules responded.
+        """
         self.logger.info("Attempting to claim hardware Resources.")
-        if self.claiming or self.claimed:
-            self.logger.warning("Already claimed Resources (%s) or currently "
-                                "claiming/releasing (%s).",
-                                self.claimed, self.claiming)
+        if modules is None:
+            self.remoteClaimRequested = False
+            if self.claiming or self.claimed:
+                self.logger.warning("Already claimed Resources (%s) or "
+                                    "currently claiming/releasing (%s).",
+                                    self.claimed, self.claiming)
+                fakeClaimEvent = threading.Event()
+                fakeClaimEvent.set()
+                return fakeClaimEvent
+            # modules claimed through an earlier request stay claimed
+            return self._start("claim", [name for name in self.modules
+                                         if name not in self.owners],
+                               owner, self.claimEvent).event
+
+        names = self._names(modules)
+        busy = [name for name in names if name in self.busy]
+        if busy:
+            self.logger.warning("Currently claiming/releasing %s.", busy)
+        toBeClaimed = [name for name in names
+                       if self.owners.get(name) != owner]
+        if busy or not toBeClaimed:
             fakeClaimEvent = threading.Event()
             fakeClaimEvent.set()
-            self.remoteClaimRequested = False
             return fakeClaimEvent
-        else:
-            self.logger.debug("Clearing events and variables.")
-            self.claimEvent.clear()
-            self.claiming = True
-            self.claimed = False
-            self.remoteClaimRequested = False
+        return self._start("claim", toBeClaimed, owner).event
 
-            self.logger.debug("Requesting claimedEvents and claimedFlags.")
-            self.claimedResponses = {}
-            self.unclaimedModules = []
-            for module in self.modules.itervalues():
-                self.claimedResponses[module] = module.claimResources()
-            self.responseCounter = 0
-            self.logger.debug("Starting timer for _waitForClaim.")
-            QtCore.QTimer.singleShot(100, self._waitForClaim)
-            return self.claimEvent
-
-    def _waitForClaim(self):
-        if self.claiming:
-            self.logger.debug("Waiting for claim.")
-            ready = True
-            for module, event in self.claimedResponses.iteritems():
-                if event.isSet():
-                    if (not module.claimed) and \
-                            not (module in self.unclaimedModules):
-                        self.logger.warning("Could not claim %s",
-                                            module._name)
-                        self.logger.debug("Module instance: %s",
-                                          module)
-                        self.unclaimedModules.append(module)
-                else:
-                    ready = False
-
-            if ready:
-                self.logger.info("All modules responded to claim.")
-                self.logger.info("Unclaimed: %s", self.unclaimedModules)
-                if not self.unclaimedModules:
-                    self.logger.info("Successfully claimed all modules.")
-                    self.claimed = True
-                    self.claimEvent.set()
-                    self.claiming = False
-                else:
-                    self.logger.debug("Could not claim the following "
-                                      "modules' hardware Resources: "
-                                      "%s", self.unclaimedModules)
-                    self.claimed = False
-                    self._releaseAfterUnsuccesfulClaim()
-            else:
-                self.responseCounter += 1
-                self.logger.debug("Claim responseCounter: %d",
-                                  self.responseCounter)
-                if self.responseCounter > 50:
-                    unresponsiveModules = []
-                    for module in self.claimedResponses:
-                        if not event.isSet():
-                            unresponsiveModules.append(module)
-                            event.set()  # signal the module to stop trying
-                    self.logger.error("Took longer than 5 seconds to claim "
-                                      "resources. Still waiting for: %s",
-                                      unresponsiveModules)
-                    self._releaseAfterUnsuccesfulClaim()
-                else:
-                    self.logger.debug("Set timer for _waitForClaim.")
-                    QtCore.QTimer.singleShot(100, self._waitForClaim)
-        else:
-            self.logger.warning("Resource claim was aborted.")
-            for event in self.claimedResponses.itervalues():
-                event.set()  # signal the modules to stop trying
-            self.logger.info("Now trying to release Resources")
-            self.claimEvent.set()
-            self.claiming = False
-            event = self.release()
-
-    def release(self):
+    def release(self, modules=None):
+        """Release the hardware resources of *modules*.
+
+        *modules* is a list of module and group names and defaults to all
+        modules. Returns a :class:`threading.Event` which is set once all
+        modules responded.
+        """
         self.logger.info("Attempting to release hardware resources.")
-        if self.claiming:
-            self.logger.warning("Already claiming/releasing Resources.")
-            if self.releaseEvent.isSet():
-                # we are likely claiming, so the caller can go on with
-                # their work and will fail later
-                fakeReleaseEvent = threading.Event()
-                fakeReleaseEvent.set()
-                self.remoteReleaseRequested = False
-                return fakeReleaseEvent
-            else:
-                # we are releasing, so the caller might as well wait
-                return self.releaseEvent
-        else:
-            self.logger.debug("Clearing events and variables.")
+        if modules is None:
+            self.remoteReleaseRequested = False
+            if self.claiming:
+                self.logger.warning("Already claiming/releasing Resources.")
+                if self.releaseEvent.isSet():
+                    # we are likely claiming, so the caller can go on with
+                    # their work and will fail later
+                    fakeReleaseEvent = threading.Event()
+                    fakeReleaseEvent.set()
+                    return fakeReleaseEvent
+                else:
+                    # we are releasing, so the caller might as well wait
+                    return self.releaseEvent
             if not self.claimed:
                 self.logger.warning("Attempting to release resources "
                                     "even though not all resources are "
                                     "currently claimed.")
-            self.claiming = True
-            self.releaseEvent.clear()
-            self.remoteReleaseRequested = False
+            return self._start("release", list(self.modules),
+                               event=self.releaseEvent).event
 
-            self.logger.debug("Requesting releasedEvents.")
-            self.releasedEvents = {}
-            for module in self.modules.itervalues():
-                self.releasedEvents[module] = module.releaseResources()
-            self.responseCounter = 0
-            self.logger.debug("Starting timer for _waitForRelease.")
-            QtCore.QTimer.singleShot(100, self._waitForRelease)
-            return self.releaseEvent
-
-    def _waitForRelease(self):
-        if self.claiming:
-            ready = True
-            for module, event in self.releasedEvents.iteritems():
-                if not event.isSet():
-                    ready = False
-            if ready:
-                self.logger.info("All modules responded to release request.")
-                self.claimed = False
-                self.releaseEvent.set()
-                self.claiming = False
-                self.logger.debug("Released resources.")
-            else:
-                self.responseCounter =+ 1
-                self.logger.debug("Release responseCounter: %d",
-                                  self.responseCounter)
-                if self.responseCounter > 50:
-                    unresponsiveModules = []
-                    for module in self.claimedResponses:
-                        if not event.isSet():
-                            unresponsiveModules.append(module)
-                            event.set()  # signal the module to stop trying
-                    self.logger.error("Took longer than 5 seconds to release "
-                                      "resources. Still waiting for: %s",
-                                      unresponsiveModules)
-                    self.releaseEvent.set()  # unfreeze the calling module
-                    self.claimed = False  # consistency
-                    self.claiming = False
-                    self.logger.debug("Signalled released resources.")
-                else:
-                    self.logger.debug("Starting timer for _waitForRelease.")
-                    QtCore.QTimer.singleShot(100, self._waitForRelease)
+        names = self._names(modules)
+        busy = [name for name in names if name in self.busy]
+        if busy:
+            self.logger.warning("Currently claiming/releasing %s.", busy)
+            fakeReleaseEvent = threading.Event()
+            fakeReleaseEvent.set()
+            return fakeReleaseEvent
+        return self._start("release", names).event
+
+    def _releaseAfterUnsuccesfulClaim(self, request):
+        if not request.succeeded:
+            return
+        names = [module._name for module in request.succeeded]
+        self.logger.info("Now trying to release %s", names)
+        if request.event is self.claimEvent:
+            self._start("release", names, event=self.releaseEvent)
         else:
-            self.logger.error("Resource release was aborted. This should never "
-                              "happen and points to a deeper issue.")
-            for event in self.releasedEvents.itervalues():
-                event.set()  # signal the modules to stop trying
-
-    def _releaseAfterUnsuccesfulClaim(self):
-        self.logger.info("Now trying to release Resources")
-        self.claimEvent.set()
-        self.claiming = False
-        event = self.release()
+            self._start("release", names)
@@ -42,3 +42,20 @@ def singleshot(func):
             self.logger.error("%s", traceback.format_exc())
 
     return inner_func
+
+
+def threadSafe(func):
+    """Mark a method as safe to be called from any thread.
+
+    Remote requests to methods marked with this decorator are executed
+    directly on a worker thread of the
+    :class:`~core.remoteServer.RemoteServer` instead of being marshalled
+    to the GUI thread, so they never wait for other requests.
+
+    .. note :: Only mark methods which neither access widgets nor
+               modify state shared with the GUI thread without a lock,
+               e.g. methods which return a copy of the module's most
+               recent readings.
+    """
+    func.threadSafe = True
+    return func
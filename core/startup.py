@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Load the modules of an experiment in parallel.
+
+Most of the time needed to load an experiment is spent by modules opening
+connections to their devices. With :class:`ParallelStartup`, the Python
+code of all modules is imported first, one module after the other, since
+Python 2 serializes imports through a global lock. Modules are then
+instantiated on the GUI thread (since their constructors create widgets)
+as soon as all modules they depend on are ready, and their
+`initHardware()` methods (see :meth:`~core.state.State.initHardware`)
+run concurrently on a pool of worker threads.
+
+Dependencies are taken from the experiment's `.conf` file, where a module
+can list the modules it depends on after a colon::
+
+    eomManager
+    pmtCounter: eomManager, trapDrive
+
+and from the optional `requires` attribute of a module class, which
+lists the names of the modules it requires.
+"""
+import logging
+import Queue
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+class ParallelStartup(object):
+    """Load modules into *state*, initializing their hardware on a pool of
+    *workers* threads.
+
+    *app* is the running :class:`QtGui.QApplication`, whose events are
+    processed while waiting for the workers.
+    """
+
+    def __init__(self, state, app, workers=8):
+        self.logger = logging.getLogger("State.ParallelStartup")
+        self.s = state
+        self.app = app
+        self.workers = workers
+
+    def run(self, toBeLoaded, dependencies=None):
+        """Load the modules *toBeLoaded*.
+
+        *dependencies* maps module names to lists of the names of modules
+        they depend on.
+        """
+        start = time.time()
+        if dependencies is None:
+            dependencies = {}
+
+        pool = ThreadPool(self.workers)
+        try:
+            classes = self._importAll(toBeLoaded)
+            graph = self._buildGraph(toBeLoaded, classes, dependencies)
+            self._startAll(pool, toBeLoaded, classes, graph)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.logger.info("Loaded %d modules in %.1f s.", len(toBeLoaded),
+                         time.time() - start)
+
+    def _importAll(self, toBeLoaded):
+        # imports would not overlap on the worker pool because of the
+        # import lock, so they run on the GUI thread
+        classes = {}
+        for name in toBeLoaded:
+            try:
+                classes[name] = self.s.moduleClass(name)
+            except Exception as e:
+                self.logger.error("Failed to import module '%s': %s: %s",
+                                  name, e.__class__.__name__, e)
+                self.logger.debug("%s", traceback.format_exc())
+            self.app.processEvents()
+        return classes
+
+    def _buildGraph(self, toBeLoaded, classes, dependencies):
+        graph = {}
+        for name in toBeLoaded:
+            required = set(dependencies.get(name, []))
+            try:
+                required.update(classes[name].requires)
+            except (KeyError, AttributeError):
+                pass
+            # modules which are not part of the configuration are loaded
+            # by the constructor through requiresModule()
+            graph[name] = {dependency for dependency in required
+                           if dependency in toBeLoaded and dependency != name}
+        return graph
+
+    def _startAll(self, pool, toBeLoaded, classes, graph):
+        pending = list(toBeLoaded)
+        running = set()
+        done = set()
+        completed = Queue.Queue()
+
+        while pending or running:
+            ready = [name for name in pending if graph[name] <= done]
+            if not ready and not running:
+                self.logger.warning("Circular dependencies between %s, "
+                                    "loading '%s' first.", pending,
+                                    pending[0])
+                ready = [pending[0]]
+
+            for name in ready:
+                pending.remove(name)
+                if self._instantiate(name, classes.get(name)):
+                    running.add(name)
+                    pool.apply_async(self._initHardware,
+                                     (name, completed))
+                else:
+                    done.add(name)
+
+            if running:
+                self.app.processEvents()
+                try:
+                    name = completed.get(timeout=0.05)
+                except Queue.Empty:
+                    continue
+                running.discard(name)
+                done.add(name)
+
+    def _instantiate(self, name, moduleClass):
+        """Add module *name* to the state on the GUI thread.
+
+        Returns `True` if its hardware still needs to be initialized.
+        """
+        if self.s.loaded(name):
+            # this can happen through baseModule.requiresModule()
+            self.logger.debug("Module %s is already loaded.", name)
+            return False
+        try:
+            self.s.addModule(name, initHardware=False,
+                             moduleClass=moduleClass)
+        except Exception as e:
+            self.logger.error("Caught exception during initialization of "
+                              "'%s': '%s: %s'.", name,
+                              e.__class__.__name__, e)
+            self.logger.error("%s", traceback.format_exc())
+            return False
+        return self.s.loaded(name)
+
+    def _initHardware(self, name, completed):
+        try:
+            self.s.initHardware(name)
+        except Exception as e:
+            self.logger.error("Failed to initialize hardware of '%s': "
+                              "'%s: %s'.", name, e.__class__.__name__, e)
+            self.logger.error("%s", traceback.format_exc())
+        finally:
+            completed.put(name)
@@ -21,13 +21,20 @@ Like *EFrame*, the `State` was designed and written by Tim Ballance.
 It was improved, documented and developed further by Kilian Kluge.
 """
 import copy
+import hashlib
 import json
 import logging
 import operator
+import os
+import sys
+import threading
+import time
 import traceback
 
 import config
 import lib.influx as influx
+import metrics
+import profiler
 import resourceManager
 import storage
 from PyQt4 import QtCore
@@ -58,7 +65,7 @@ class State(QtCore.QObject):
     aboutToChange = QtCore.pyqtSignal()
     stateChanged = QtCore.pyqtSignal()
 
-    def __init__(self, mainWindow):
+    def __init__(self, mainWindow, bufferedInflux=False, alwaysReload=False):
         super(State, self).__init__()
         self.logger = logging.getLogger("State")
 
@@ -66,27 +73,215 @@ class State(QtCore.QObject):
         self.modules = {}
         self.requiredBy = {}
 
+        # IMPORT REGISTRY
+        self.alwaysReload = alwaysReload
+        self.importRegistry = {}  # name -> (mtime, size, md5) of source
+
         self.config = config.XMLConfig(self.modules)
         self.resources = resourceManager.Resources(self.modules)
         self.store = storage.Storage(self.config.dataPath)
-        self.influx = influx.Influx()
+        self.influx = influx.Influx(buffered=bufferedInflux)
+
+        # REMOTE CALLS
+        self._dispatchCache = {}  # method -> callable
+        self.dispatchSummaryInterval = 60  # s
+        self._dispatchSummaryTime = time.time()
+        self._dispatchCalls = 0
+        self._dispatchErrors = 0
+        self.aboutToChange.connect(self._clearDispatchCache)
+        self.stateChanged.connect(self._clearDispatchCache)
+        # getStatus and getStatusSince return the snapshot taken on the GUI
+        # thread when called from other threads
+        self.threadSafeMethods = {
+            "getMetrics", "getStatus", "getStatusSince", "getUpdateStats",
+            "getUpdateTimings", "getStartupReport", "loaded",
+            "resources.areClaimed", "resources.isClaiming",
+            "resources.ownership", "resources.remoteClaim",
+            "resources.remoteRelease", "resources.remoteClaimRequestHandled",
+            "resources.remoteReleaseRequestHandled"}
+        # remote calls to all other methods may change the configuration
+        self.queryMethods = set(self.threadSafeMethods)
+
+        # METRICS
+        self.metrics = metrics.registry
+        self.metricsInterval = 30000  # ms
+        # metrics are only written to InfluxDB if it is written to from a
+        # background thread (see --buffered-influx)
+        self.metricsToInflux = True
+        self._metricsFlushFailed = False
+        self.metrics.gauge("influx.queueDepth",
+                           lambda: self.influx.stats().get("queueDepth", 0))
+        self.metrics.gauge("influx.dropped",
+                           lambda: self.influx.stats().get("dropped", 0))
+        self.metricsTimer = QtCore.QTimer(self)
+        self.metricsTimer.timeout.connect(self.flushMetrics)
+        self.metricsTimer.start(self.metricsInterval)
+
+        # CONFIG JOURNAL
+        # the configuration is only captured after user input, remote
+        # calls or changes of the loaded modules
+        self.captureInterval = 10000  # ms
+        self.configChanged = False
+        self._inputEvents = frozenset((QtCore.QEvent.KeyRelease,
+                                       QtCore.QEvent.MouseButtonRelease,
+                                       QtCore.QEvent.Wheel))
+        if QtCore.QCoreApplication.instance() is not None:
+            QtCore.QCoreApplication.instance().installEventFilter(self)
+        self.stateChanged.connect(self.markConfigChanged)
+        self.captureTimer = QtCore.QTimer(self)
+        self.captureTimer.timeout.connect(self.captureConfig)
+        self.captureTimer.start(self.captureInterval)
+
+        # GUI UPDATES
+        self._dirty = set()
+        self._dirtyTracked = set()
+        self._dirtyLock = threading.Lock()
+        self._visible = set()
+        self.updateStats = {"executed": 0, "skipped": 0,
+                            "totalExecuted": 0, "totalSkipped": 0}
+
+        # UPDATE BUDGETS
+        self.updateTargets = {}  # name -> target update interval in ms
+        self.updateTimings = {}  # name -> timing statistics
+        self.moduleBudget = 20.0  # ms, modules slower than this are throttled
+        self.tickBudget = 50.0  # ms per update for throttled modules
+        self.slowDutyCycle = 0.1  # fraction of time spent in slow updates
+        self._lastUpdate = {}  # name -> time of last update
+
+        # STARTUP PROFILING
+        self.profiler = profiler.StartupProfiler()
+        self.profileToInflux = False
+        self._firstUpdatePending = set()
+        self._reportPending = False
+        self.loadingCompleted.connect(self._onLoadingCompleted)
+
+        # STATUS CACHE
+        self.statusVersion = 0
+        self._statusCache = {}  # name -> [moduleVersion, fragment, version]
+        self._statusRemoved = {}  # name -> version
+        self._statusJSON = {}  # compact -> (statusVersion, JSON)
+        self._statusLock = threading.RLock()
+        self._statusError = None
 
     def _dispatch(self, method, params):
-        """Dispatch RPC calls from :class:`~modules.remoteControl.remoteControl`."""
-        self.logger.info("Remote request: %s%s", method, params)
+        """Dispatch RPC calls from :class:`~modules.remoteControl.remoteControl`.
+
+        Calling `multicall` (or `system.multicall`) executes a list of
+        calls in a single request (see :meth:`multicall`).
+
+        Individual requests are logged at level DEBUG. A summary of all
+        requests is logged at level INFO every :attr:`dispatchSummaryInterval`
+        seconds.
+        """
+        if method in ("multicall", "system.multicall"):
+            return self.multicall(*params)
         try:
-            func = operator.attrgetter(method)(self)
+            return self._call(method, params, logging.ERROR)
+        finally:
+            self._logDispatchSummary()
+
+    def multicall(self, calls):
+        """Execute a list of remote *calls* in a single request.
+
+        Each call is either a dictionary with the keys `methodName` and
+        `params` (as for XML-RPC's `system.multicall`) or a pair of the
+        method name and the list of parameters. Calls are executed in
+        order, and a failing call does not abort the remaining calls.
+
+        Returns a list with one entry per call: a list containing the
+        result if the call succeeded, or a dictionary with the keys
+        `faultCode` and `faultString` if it failed.
+        """
+        start = time.time()
+        results = []
+        failed = 0
+        for call in calls:
+            try:
+                if isinstance(call, dict):
+                    method, params = call["methodName"], call["params"]
+                else:
+                    method, params = call
+                results.append([self._call(method, params, logging.DEBUG)])
+            except Exception as e:
+                failed += 1
+                results.append({"faultCode": 1,
+                                "faultString": "%s: %s" % (
+                                    e.__class__.__name__, e)})
+        self.logger.log(logging.WARNING if failed else logging.INFO,
+                        "Remote multicall: %d calls (%d failed) in %d ms.",
+                        len(calls), failed, (time.time() - start) * 1000)
+        return results
+
+    def _call(self, method, params, errorLevel):
+        self.logger.debug("Remote request: %s%s", method, params)
+        if method not in self.queryMethods:
+            self.configChanged = True
+        self.metrics.counter("rpc.calls").inc()
+        self._dispatchCalls += 1
+        try:
+            func = self._resolve(method)
         except AttributeError as e:
-            self.logger.error("Remote request failed: No method %s", method)
+            self.metrics.counter("rpc.errors").inc()
+            self._dispatchErrors += 1
+            self.logger.log(errorLevel, "Remote request failed: No method %s",
+                            method)
             raise e
         else:
             try:
-                return func(*params)
+                with self.metrics.timer("rpc.duration"):
+                    return func(*params)
             except Exception as e:
-                self.logger.error("Remote call to %s failed: %s",
-                                  method, e)
+                self.metrics.counter("rpc.errors").inc()
+                self._dispatchErrors += 1
+                self.logger.log(errorLevel, "Remote call to %s failed: %s",
+                                method, e)
                 raise e
 
+    def isThreadSafe(self, method):
+        """Check whether *method* can be called from any thread.
+
+        This is the case for the methods listed in
+        :attr:`threadSafeMethods` and for module methods marked with
+        :func:`~core.stability.threadSafe`.
+        """
+        if method in self.threadSafeMethods:
+            return True
+        try:
+            return getattr(self._resolve(method), "threadSafe", False)
+        except AttributeError:
+            return False
+
+    def _resolve(self, method):
+        """Return the callable for the dotted path *method*.
+
+        Methods of the `State` and of modules are cached until the
+        state changes. Longer paths (e.g. to methods of objects held by
+        modules) are resolved on every call, since these objects might
+        be replaced at any time.
+        """
+        try:
+            return self._dispatchCache[method]
+        except KeyError:
+            func = operator.attrgetter(method)(self)
+            if method.count(".") <= 1:
+                self._dispatchCache[method] = func
+            return func
+
+    def _clearDispatchCache(self):
+        self._dispatchCache.clear()
+
+    def _logDispatchSummary(self):
+        now = time.time()
+        interval = now - self._dispatchSummaryTime
+        if interval >= self.dispatchSummaryInterval:
+            if self._dispatchCalls:
+                self.logger.info("Handled %d remote requests (%d failed) in "
+                                 "the last %d s.", self._dispatchCalls,
+                                 self._dispatchErrors, interval)
+            self._dispatchCalls = 0
+            self._dispatchErrors = 0
+            self._dispatchSummaryTime = now
+
     def __getattr__(self, name):
         try:
             return self.modules[name]
@@ -98,18 +293,258 @@ class State(QtCore.QObject):
 
         If there is any exception thrown during update,
         the widget is hidden.
+
+        Modules which use :meth:`markDirty` (or set the attribute
+        `dirtyTracking`) are only updated after they were marked dirty or
+        when their widget becomes visible. All other modules are updated
+        on every call. The number of executed and skipped updates is
+        available through :meth:`getUpdateStats`.
+
+        Every module's update is timed. Modules are not updated more
+        often than their target interval (see :meth:`setUpdateRate` or
+        the module attribute `targetUpdateInterval` in ms). Modules whose
+        update takes longer than :attr:`moduleBudget` on average are
+        updated less often, such that at most :attr:`slowDutyCycle` of the
+        time is spent on them, and share :attr:`tickBudget` per call in a
+        round-robin fashion. Timings are available through
+        :meth:`getUpdateTimings`.
+
+        Finally, the status of all modules is cached for calls to
+        :meth:`getStatus` from other threads.
         """
+        now = time.time()
+        with self._dirtyLock:
+            dirty, self._dirty = self._dirty, set()
+
+        executed = 0
+        skipped = 0
+        visible = set()
+        slow = []
+        deferred = set()
         for name, module in self.modules.iteritems():
             if module.widget.isVisible():
-                try:
+                visible.add(name)
+                if name in self._visible:
+                    if name in self._dirtyTracked and name not in dirty:
+                        skipped += 1
+                        continue
+                    if not self._updateDue(name, module, now):
+                        self._skipUpdate(name, dirty, deferred)
+                        skipped += 1
+                        continue
+                    if self._isSlow(name):
+                        slow.append(name)
+                        continue
+                executed += 1
+                self._updateModule(name, module)
+
+        # update slow modules in the order of their last update
+        slow.sort(key=lambda name: self._lastUpdate.get(name, 0))
+        spent = 0
+        for name in slow:
+            if spent < self.tickBudget:
+                executed += 1
+                spent += self._updateModule(name, self.modules[name])
+            else:
+                self._skipUpdate(name, dirty, deferred)
+                skipped += 1
+
+        if deferred:
+            with self._dirtyLock:
+                self._dirty.update(deferred)
+
+        self.metrics.histogram("gui.update").observe((time.time() - now)
+                                                     * 1000)
+        self.metrics.counter("gui.updates.executed").inc(executed)
+        self.metrics.counter("gui.updates.skipped").inc(skipped)
+
+        self._visible = visible
+        self.updateStats["executed"] = executed
+        self.updateStats["skipped"] = skipped
+        self.updateStats["totalExecuted"] += executed
+        self.updateStats["totalSkipped"] += skipped
+
+        self._snapshotStatus()
+
+        if self._reportPending:
+            self._reportPending = False
+            self._firstUpdatePending.clear()
+            self.profiler.finish(
+                influx=self.influx if self.profileToInflux else None)
+
+    def markDirty(self, name):
+        """Request a GUI update of module *name* with the next update.
+
+        This can be called from any thread, e.g. by a module's
+        acquisition thread when new data arrives. Once a module called
+        `markDirty`, it is only updated when it was marked dirty.
+        """
+        with self._dirtyLock:
+            self._dirtyTracked.add(name)
+            self._dirty.add(name)
+
+    def getUpdateStats(self):
+        """Return the number of executed and skipped GUI updates.
+
+        `executed` and `skipped` refer to the most recent update,
+        `totalExecuted` and `totalSkipped` to all updates so far.
+        """
+        return dict(self.updateStats)
+
+    def _updateModule(self, name, module):
+        """Update module *name* and return the duration in ms."""
+        start = time.time()
+        try:
+            if name in self._firstUpdatePending:
+                self._firstUpdatePending.discard(name)
+                with self.profiler.phase(name, "firstUpdate"):
                     module.update()
-                except Exception as e:
-                    self.logger.critical(
-                        "Unhandled exception during GUI update: %s", e)
-                    self.logger.error(traceback.format_exc())
-                    module.widget.hide()
+            else:
+                module.update()
+        except Exception as e:
+            self.logger.critical(
+                "Unhandled exception during GUI update: %s", e)
+            self.logger.error(traceback.format_exc())
+            module.widget.hide()
+        end = time.time()
+        duration = (end - start) * 1000  # duration in ms
+
+        self._lastUpdate[name] = end
+        timing = self.updateTimings.setdefault(
+            name, {"last": 0.0, "mean": duration, "max": 0.0,
+                   "updates": 0, "skipped": 0})
+        timing["last"] = duration
+        timing["mean"] = 0.8 * timing["mean"] + 0.2 * duration
+        timing["max"] = max(timing["max"], duration)
+        timing["updates"] += 1
+        return duration
+
+    def _skipUpdate(self, name, dirty, deferred):
+        if name in dirty:
+            deferred.add(name)  # keep the dirty mark for the next update
+        try:
+            self.updateTimings[name]["skipped"] += 1
+        except KeyError:
+            pass
+
+    def _isSlow(self, name):
+        try:
+            return self.updateTimings[name]["mean"] > self.moduleBudget
+        except KeyError:
+            return False
+
+    def updateInterval(self, name):
+        """Return the current update interval (in ms) of module *name*."""
+        try:
+            target = self.updateTargets[name]
+        except KeyError:
+            target = getattr(self.modules[name], "targetUpdateInterval", 0)
+        if self._isSlow(name):
+            return max(target,
+                       self.updateTimings[name]["mean"] / self.slowDutyCycle)
+        return target
+
+    def _updateDue(self, name, module, now):
+        try:
+            last = self._lastUpdate[name]
+        except KeyError:
+            return True
+        return (now - last) * 1000 >= self.updateInterval(name)
+
+    def setUpdateRate(self, name, rate):
+        """Update module *name* at most *rate* times per second.
+
+        A *rate* of `0` removes the limit.
+        """
+        if rate:
+            self.updateTargets[name] = 1000.0 / rate
+        else:
+            self.updateTargets.pop(name, None)
+
+    def getUpdateTimings(self):
+        """Return the GUI update timings of all modules.
+
+        For every module, the duration of the `last` update, the moving
+        average (`mean`) and maximum (`max`) duration (all in ms), the
+        number of executed (`updates`) and `skipped` updates, and the
+        current update `interval` (in ms) are given.
+        """
+        timings = {}
+        for name, timing in self.updateTimings.items():
+            if name in self.modules:
+                timings[name] = dict(timing)
+                timings[name]["interval"] = self.updateInterval(name)
+        return timings
+
+    def getMetrics(self):
+        """Return the current values of all metrics.
 
-    def getStatus(self):
+        See :mod:`core.metrics` for details.
+        """
+        return self.metrics.snapshot()
+
+    def flushMetrics(self):
+        """Write all metrics to InfluxDB in a single batch.
+
+        Skipped unless writing to InfluxDB is buffered, since a synchronous
+        write would block the GUI thread.
+        """
+        if not self.metricsToInflux or self.influx.writer is None:
+            return
+        try:
+            self.influx.write(self.metrics.points())
+        except Exception as e:
+            if not self._metricsFlushFailed:
+                self.logger.error("Failed to write metrics to InfluxDB: %s",
+                                  e)
+            self._metricsFlushFailed = True
+        else:
+            self._metricsFlushFailed = False
+
+    def eventFilter(self, obj, event):
+        if event.type() in self._inputEvents:
+            self.configChanged = True
+        return False
+
+    def markConfigChanged(self):
+        """Capture the configuration of all modules at the next interval.
+
+        Modules which change their settings without user input or remote
+        calls (e.g. in a scan) should call this method.
+        """
+        self.configChanged = True
+
+    def captureConfig(self):
+        """Write configuration changes of all modules to the journal.
+
+        Does nothing unless :meth:`markConfigChanged` was called (or user
+        input or a remote call occurred) since the last capture. See
+        :meth:`~core.config.XMLConfig.capture`.
+        """
+        if not self.configChanged:
+            return
+        self.configChanged = False
+        with self.metrics.timer("config.capture"):
+            try:
+                self.config.capture()
+            except Exception as e:
+                self.logger.error("Failed to capture configuration: %s", e)
+                self.logger.debug("%s", traceback.format_exc())
+
+    def _onLoadingCompleted(self):
+        # the startup report is compiled after the first GUI update
+        self._reportPending = True
+
+    def getStartupReport(self):
+        """Return the timings of the most recent experiment load.
+
+        See :class:`~core.profiler.StartupProfiler` for details.
+        """
+        if self.profiler.lastReport is None:
+            return self.profiler.report()
+        return self.profiler.lastReport
+
+    def getStatus(self, compact=False):
         """Compile a status message of all loaded EFrame modules.
 
         Status messages are regularly attached to measurements to
@@ -119,6 +554,7 @@ class State(QtCore.QObject):
         The status message is returned as JSON, which is readily
         parsed into a Python dictionary, stored in any of the
         databases used in the IonCavity ecosystem, and human-readable.
+        If *compact* is `True`, the JSON is not indented.
 
         .. note:: If the status is stored in the header of a CSV
            file using `np.savetxt()`, it can be extracted using
@@ -127,44 +563,247 @@ class State(QtCore.QObject):
         The use of a custom :class:`~lib.statusEncoder.statusEncoder`
         allows for modules to pass their internal status dictionary
         (including references to non-picklable class-instances).
+
+        Each module's status is encoded once and cached. Modules which
+        provide a `statusVersion` attribute are only asked for their
+        status again after they changed their `statusVersion`. All other
+        modules are asked on every call, but the message is only rebuilt
+        if their status actually changed.
+
+        Modules are only asked for their status on the GUI thread. Calls
+        from other threads (e.g. remote requests) return the snapshot
+        taken with the last GUI update (see :meth:`updateAllModules`), so
+        they never wait for the GUI thread.
         """
-        status = {name: module_.getStatus()
-                  for name, module_ in self.modules.iteritems()
-                  if module_.getStatus()}
-        return json.dumps(status, indent=4, cls=StatusEncoder)
+        with self._statusLock:
+            if self._onGUIThread():
+                self._refreshStatus()
+            try:
+                version, message = self._statusJSON[compact]
+            except KeyError:
+                version = None
+            if version != self.statusVersion:
+                names = sorted(name for name, entry
+                               in self._statusCache.iteritems()
+                               if entry[1] is not None)
+                if compact:
+                    message = "{%s}" % ",".join(
+                        "%s:%s" % (json.dumps(name),
+                                   self._statusCache[name][1])
+                        for name in names)
+                elif names:
+                    message = "{\n%s\n}" % ",\n".join(
+                        "    %s: %s" % (json.dumps(name),
+                                        self._indentedFragment(name))
+                        for name in names)
+                else:
+                    message = "{}"
+                self._statusJSON[compact] = (self.statusVersion, message)
+            return message
+
+    def getStatusSince(self, version):
+        """Return the status of all modules which changed after *version*.
+
+        The result is a compact JSON object with the entries
+        `version` (the current :attr:`statusVersion`), `status` (a
+        dictionary of the status of all changed modules) and `removed`
+        (a list of all modules removed since *version*). Pass the returned
+        `version` to the next call to receive only subsequent changes.
+        Like :meth:`getStatus`, this can be called from any thread.
+        """
+        with self._statusLock:
+            if self._onGUIThread():
+                self._refreshStatus()
+            changed = ["%s:%s" % (json.dumps(name), entry[1])
+                       for name, entry in self._statusCache.iteritems()
+                       if entry[2] > version and entry[1] is not None]
+            removed = [name for name, removedAt
+                       in self._statusRemoved.iteritems()
+                       if removedAt > version]
+            return '{"version":%d,"status":{%s},"removed":%s}' % (
+                self.statusVersion, ",".join(changed), json.dumps(removed))
+
+    def invalidateStatus(self, name):
+        """Discard the cached status of module *name*.
+
+        Subscribers to :meth:`getStatusSince` are told that the status was
+        removed, until the module reports its status again.
+        """
+        with self._statusLock:
+            if self._statusCache.pop(name, None) is not None:
+                self.statusVersion += 1
+                self._statusRemoved[name] = self.statusVersion
 
-    def addModule(self, name):
+    def _onGUIThread(self):
+        return QtCore.QThread.currentThread() == self.thread()
+
+    def _snapshotStatus(self):
+        """Refresh the cached status for calls from other threads."""
+        try:
+            with self._statusLock:
+                self._refreshStatus()
+        except Exception as e:
+            # only log once per problem, this is called on every update
+            if str(e) != self._statusError:
+                self.logger.error("Failed to get the status of all "
+                                  "modules: %s", e)
+            self._statusError = str(e)
+        else:
+            self._statusError = None
+
+    def _refreshStatus(self):
+        for name, module_ in self.modules.items():
+            moduleVersion = getattr(module_, "statusVersion", None)
+            entry = self._statusCache.get(name)
+            if entry is not None and moduleVersion is not None \
+                    and entry[0] == moduleVersion:
+                continue
+
+            status = module_.getStatus()
+            if status:
+                fragment = json.dumps(status, separators=(",", ":"),
+                                      cls=StatusEncoder)
+            else:
+                fragment = None
+
+            if entry is None or entry[1] != fragment:
+                self.statusVersion += 1
+                self._statusCache[name] = [moduleVersion, fragment,
+                                           self.statusVersion]
+                self._statusRemoved.pop(name, None)
+            else:
+                entry[0] = moduleVersion
+
+        for name in self._statusCache.keys():
+            if name not in self.modules:
+                del self._statusCache[name]
+                self.statusVersion += 1
+                self._statusRemoved[name] = self.statusVersion
+
+    def _indentedFragment(self, name):
+        entry = self._statusCache[name]
+        if len(entry) < 4:
+            indented = json.dumps(json.loads(entry[1]), indent=4)
+            entry.append(indented.replace("\n", "\n    "))
+        return entry[3]
+
+    def addModule(self, name, initHardware=True, moduleClass=None):
         """Add module *name* to `State`.
 
         Dependency management is accomplished through
         :class:`modules.baseModule.baseModule.requiresModule`.
+
+        Unless *initHardware* is `False`, the module's hardware connections
+        are initialized right away (see :meth:`initHardware`). If the
+        *moduleClass* was already imported, it is not imported again.
         """
-        moduleObject = self.importModule(name)
+        moduleObject = self.importModule(name, moduleClass)
 
         if name not in self.modules:
             self.logger.info("Adding '%s' to state.", name)
             self.modules[name] = moduleObject
+            self._clearDispatchCache()
+            if getattr(moduleObject, "dirtyTracking", False):
+                with self._dirtyLock:
+                    self._dirtyTracked.add(name)
+            if initHardware:
+                self.initHardware(name)
         else:
             self.logger.error("A module with name '%s' is already "
                               "registered. Please choose a unique name.",
                               name)
             self.logger.debug("Existing module: %s", self.modules[name])
 
-    def importModule(self, name):
-        """Import module *name* and return an instance."""
+    def initHardware(self, name):
+        """Initialize the hardware connections of module *name*.
+
+        Modules can move slow initialization, such as opening network
+        connections to their devices, from their constructor into an
+        optional `initHardware()` method. It must not create or access
+        any widgets, as it might be called from a worker thread during
+        parallel startup (see :class:`~core.startup.ParallelStartup`).
+        """
         try:
-            module_ = __import__("modules.%s.%s" % (name, name),
-                                 fromlist=[name])
-            reload(module_)  # ensure we don't use an old .pyc
+            initHardware = self.modules[name].initHardware
+        except AttributeError:
+            return
+        with self.profiler.phase(name, "initHardware"):
+            initHardware()
+
+    def loadModuleCode(self, name):
+        """Import the Python module which defines module *name*.
+
+        If the module was imported before, it is only reloaded if its
+        source file changed since then (as recorded in
+        :attr:`importRegistry`). Set :attr:`alwaysReload` to reload
+        modules on every import regardless.
+
+        .. note:: Only the file `modules/<name>/<name>.py` is tracked.
+           Changes to other files of a module are picked up only with
+           :attr:`alwaysReload`.
+        """
+        fullName = "modules.%s.%s" % (name, name)
+        try:
+            imported = fullName in sys.modules
+            with self.profiler.phase(name, "import"):
+                module_ = __import__(fullName, fromlist=[name])
+            if imported and (self.alwaysReload or
+                             self._sourceChanged(name, module_)):
+                with self.profiler.phase(name, "reload"):
+                    reload(module_)
         except ImportError as e:
             raise InitErrorException(e)
 
         try:
-            moduleClass = getattr(module_, name)
+            self.importRegistry[name] = self._sourceSignature(
+                module_, self.importRegistry.get(name))
+        except (IOError, OSError):
+            self.importRegistry.pop(name, None)
+        return module_
+
+    def _sourceSignature(self, module_, previous=None):
+        sourceFile = os.path.splitext(module_.__file__)[0] + ".py"
+        stat = os.stat(sourceFile)
+        if previous is not None and previous[:2] == (stat.st_mtime,
+                                                     stat.st_size):
+            return previous
+        with open(sourceFile, "rb") as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        return stat.st_mtime, stat.st_size, digest
+
+    def _sourceChanged(self, name, module_):
+        previous = self.importRegistry.get(name)
+        if previous is None:
+            # imported outside of the State, so we don't know which version
+            return True
+        try:
+            current = self._sourceSignature(module_, previous)
+        except (IOError, OSError):
+            return True
+        # e.g. a git checkout changes the mtime, but not the content
+        return current[2] != previous[2]
+
+    def moduleClass(self, name):
+        """Return the class of module *name*, importing it if necessary."""
+        module_ = self.loadModuleCode(name)
+        try:
+            return getattr(module_, name)
         except AttributeError as e:
             raise InitErrorException(e)
 
-        moduleObject = moduleClass(self)
+    def importModule(self, name, moduleClass=None):
+        """Import module *name* and return an instance.
+
+        If the module's *moduleClass* was already obtained through
+        :meth:`moduleClass`, it is not imported again.
+        """
+        if moduleClass is None:
+            moduleClass = self.moduleClass(name)
+
+        self.profiler.instrument(moduleClass, name, "parseConfig")
+        with self.profiler.phase(name, "instantiate"):
+            moduleObject = moduleClass(self)
+        self._firstUpdatePending.add(name)
         self.requiredBy[name] = []
         self.logger.info("Successfully imported %s", name)
         return moduleObject
@@ -172,6 +811,7 @@ class State(QtCore.QObject):
     def reloadModule(self, name):
         """Reload module *name*, taking care of dependencies."""
         dependentModules = copy.copy(self.requiredBy[name])
+        self.profiler.reset()
         self.aboutToChange.emit()
         self.logger.info("Removing dependent modules.")
         for module_ in dependentModules:
@@ -179,7 +819,7 @@ class State(QtCore.QObject):
 
         self.logger.info("Reloading module '%s'.", name)
         self.removeModule(name)
-        self.addModule(self.importModule(name))
+        self.addModule(name)
 
         self.logger.info("Adding dependent modules.")
         for module_ in dependentModules:
@@ -213,6 +853,9 @@ class State(QtCore.QObject):
                 "removing '%s'.", module_, name, name)
             self.removeModule(module_)
 
+        # changes since the last capture would be lost otherwise
+        self.config.unload(name)
+
         self.logger.debug("Call remove() method of module '%s'.", name)
         try:
             try:
@@ -226,6 +869,12 @@ class State(QtCore.QObject):
             self.logger.debug("Remove instance %s of '%s' from State.",
                               self.modules[name], name)
             del self.modules[name]
+            self._clearDispatchCache()
+
+        # a reloaded module may report the same statusVersion
+        self.invalidateStatus(name)
+        # a reloaded module starts with its resources released
+        self.resources.forget(name)
 
         for requirements in self.requiredBy.itervalues():
             try:
@@ -235,9 +884,17 @@ class State(QtCore.QObject):
 
         del self.requiredBy[name]
 
+        with self._dirtyLock:
+            self._dirtyTracked.discard(name)
+            self._dirty.discard(name)
+        self.updateTimings.pop(name, None)
+        self._lastUpdate.pop(name, None)
+
     def removeAllModules(self):
         """Remove all modules from the `State`."""
         self.logger.info("Removing all modules.")
         self.aboutToChange.emit()
         for module in self.modules.keys():
             self.removeModule(module)
+        self.store.flush()
+        self.influx.flush(timeout=1.0)  # do not freeze the GUI
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Push changes of the status of modules to subscribers.
+
+Instead of polling :meth:`~core.state.State.getStatus`, dashboards and
+analysis scripts can connect to the :class:`StatusPublisher` and subscribe
+to the status of individual modules or to individual status keys. While
+there are subscribers, the publisher polls
+:meth:`~core.state.State.getStatusSince`, flattens the status of all
+changed modules into keys like `laser.frequency.setpoint` and pushes only
+values which actually changed.
+
+Messages use the framing of :mod:`lib.binaryProtocol`. A client sends::
+
+    {"subscribe": {"modules": ["laser"], "keys": ["pmtCounter.counts"],
+                   "rate": 5}}
+
+and receives the current values of all matching keys, followed by
+updates of the form::
+
+    {"time": ..., "values": {key: [value, timestamp]}, "removed": [key]}
+
+at most *rate* times per second. A subscription can be replaced at any
+time by sending a new `subscribe` message.
+
+Each subscriber has a mailbox which holds only the latest value of every
+key. If a subscriber does not keep up, intermediate values are dropped
+instead of being buffered, and subscribers which do not accept data for
+*sendTimeout* seconds are disconnected.
+
+Use :class:`lib.binaryClient.StatusStream` to subscribe.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from SocketServer import BaseRequestHandler, ThreadingMixIn, TCPServer
+
+try:
+    from SocketServer import UnixStreamServer
+except ImportError:  # no Unix-domain sockets on Windows
+    UnixStreamServer = None
+
+from lib import binaryProtocol as protocol
+from lib.statusEncoder import flatten
+
+
+class _Subscriber(object):
+    def __init__(self, sock, client):
+        self.sock = sock
+        self.client = client
+        self.modules = None  # None: all modules
+        self.keys = None
+        self.rate = 10.0  # Hz
+        self.lock = threading.Condition(threading.Lock())
+        self.pending = {}  # key -> [value, timestamp]
+        self.removed = set()
+        self.closed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.lastSent = 0.0
+
+    def subscribe(self, modules=None, keys=None, rate=None):
+        with self.lock:
+            self.modules = set(modules) if modules else None
+            self.keys = list(keys) if keys else None
+            if rate:
+                self.rate = float(rate)
+            self.pending = {}
+            self.removed = set()
+
+    def matches(self, key):
+        if self.modules is None and self.keys is None:
+            return True
+        if self.modules is not None and key.split(".", 1)[0] in self.modules:
+            return True
+        if self.keys is not None:
+            for prefix in self.keys:
+                if key == prefix or key.startswith(prefix + "."):
+                    return True
+        return False
+
+    def post(self, values, removed):
+        with self.lock:
+            for key, entry in values.iteritems():
+                if self.matches(key):
+                    if key in self.pending:
+                        self.coalesced += 1
+                    self.pending[key] = entry
+                    self.removed.discard(key)
+            for key in removed:
+                if self.matches(key):
+                    self.pending.pop(key, None)
+                    self.removed.add(key)
+            if self.pending or self.removed:
+                self.lock.notify()
+
+    def take(self):
+        """Wait for changes and return them, respecting the rate limit."""
+        with self.lock:
+            while not self.closed and not (self.pending or self.removed):
+                self.lock.wait(1.0)
+            if self.closed:
+                return None
+            delay = self.lastSent + 1.0 / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)  # changes keep coalescing meanwhile
+        with self.lock:
+            values, self.pending = self.pending, {}
+            removed, self.removed = list(self.removed), set()
+            self.lastSent = time.time()
+        return {"time": self.lastSent, "values": values, "removed": removed}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+
+
+class _RequestHandler(BaseRequestHandler):
+    def handle(self):
+        publisher = self.server.owner
+        client = self.client_address[0] if self.client_address else "local"
+        subscriber = _Subscriber(self.request, client)
+        sender = None
+        publisher.logger.debug("Subscriber %s connected.", client)
+
+        try:
+            while True:
+                try:
+                    message = protocol.receive(self.request)
+                except protocol.DecodeError:
+                    publisher.logger.warning("Invalid message from %s.",
+                                             client)
+                    continue
+                except (EOFError, socket.error, protocol.ProtocolError):
+                    break
+                try:
+                    subscription = message["subscribe"]
+                    subscriber.subscribe(subscription.get("modules"),
+                                         subscription.get("keys"),
+                                         subscription.get("rate"))
+                except (KeyError, TypeError, AttributeError, ValueError):
+                    publisher.logger.warning("Invalid message from %s.",
+                                             client)
+                    continue
+                publisher.add(subscriber)
+                if sender is None:
+                    sender = threading.Thread(target=publisher.send,
+                                              args=(subscriber,),
+                                              name="StatusPublisher.send")
+                    sender.daemon = True
+                    sender.start()
+        finally:
+            subscriber.close()
+            publisher.remove(subscriber)
+            publisher.logger.debug("Subscriber %s disconnected.", client)
+
+
+class _ThreadedTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if UnixStreamServer is not None:
+    class _ThreadedUnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+
+class StatusPublisher(object):
+    """Publish status changes of *state* to subscribers on *address*.
+
+    *address* is either `host:port` or the path of a Unix-domain socket.
+    While there are subscribers, the status is polled every *interval*
+    seconds.
+    """
+
+    def __init__(self, state, address, interval=0.1, sendTimeout=10.0):
+        self.logger = logging.getLogger("State.StatusPublisher")
+        self.s = state
+        self.interval = interval
+        self.sendTimeout = sendTimeout
+
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.values = {}  # key -> [value, timestamp]
+        self.version = 0
+        self.running = threading.Event()
+        self.active = threading.Event()  # set while there are subscribers
+
+        family, self.address = protocol.parseAddress(address)
+        if family == socket.AF_INET:
+            self.server = _ThreadedTCPServer(self.address, _RequestHandler)
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address)  # left over from a previous run
+            self.server = _ThreadedUnixServer(self.address, _RequestHandler)
+        self.server.owner = self
+        self.threads = []
+
+    def start(self):
+        """Start polling the status and accepting subscribers."""
+        self.running.set()
+        self.threads = [
+            threading.Thread(target=self.server.serve_forever,
+                             name="StatusPublisher.serve"),
+            threading.Thread(target=self._poll, name="StatusPublisher.poll")]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        self.logger.info("Publishing status changes on %s.",
+                         self.server.server_address)
+
+    def stop(self):
+        """Disconnect all subscribers and stop publishing."""
+        if not self.running.is_set():
+            return
+        self.running.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+            try:
+                subscriber.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.server.address_family != socket.AF_INET:
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+        self.logger.info("Stopped publishing status changes.")
+
+    def add(self, subscriber):
+        """Register *subscriber* and post all current values to it."""
+        with self.lock:
+            self.subscribers.add(subscriber)
+            values = dict(self.values)
+            self.active.set()
+        subscriber.post(values, [])
+
+    def remove(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.active.clear()
+
+    def stats(self):
+        """Return the number of messages sent to and values dropped for
+        each subscriber."""
+        with self.lock:
+            return [{"client": subscriber.client,
+                     "sent": subscriber.sent,
+                     "coalesced": subscriber.coalesced}
+                    for subscriber in self.subscribers]
+
+    def send(self, subscriber):
+        while self.running.is_set():
+            message = subscriber.take()
+            if message is None:
+                break
+            try:
+                protocol.send(subscriber.sock, message, self.sendTimeout)
+            except (socket.error, TypeError, ValueError) as e:
+                self.logger.warning("Disconnecting subscriber %s: %s",
+                                    subscriber.client, e)
+                subscriber.close()
+                try:
+                    subscriber.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                break
+            subscriber.sent += 1
+
+    def _poll(self):
+        while self.running.is_set():
+            if not self.active.is_set():
+                # the values are outdated by the time the next subscriber
+                # connects, so start over
+                with self.lock:
+                    self.values = {}
+                self.version = 0
+                self.active.wait(1.0)
+                continue
+            start = time.time()
+            try:
+                self._publishChanges()
+            except Exception as e:
+                self.logger.error("Failed to publish status changes: %s", e)
+            time.sleep(max(0.0, self.interval - (time.time() - start)))
+
+    def _publishChanges(self):
+        # returns the snapshot taken with the last GUI update
+        changes = json.loads(self.s.getStatusSince(self.version))
+        self.version = changes["version"]
+        now = time.time()
+
+        changed = {}
+        removed = []
+        for name, status in changes["status"].iteritems():
+            values = flatten(status, name)
+            with self.lock:
+                for key in [key for key in self.values
+                            if key.split(".", 1)[0] == name
+                            and key not in values]:
+                    del self.values[key]
+                    removed.append(key)
+                for key, value in values.iteritems():
+                    entry = self.values.get(key)
+                    if entry is None or entry[0] != value:
+                        self.values[key] = changed[key] = [value, now]
+        with self.lock:
+            for name in changes["removed"]:
+                for key in [key for key in self.values
+                            if key.split(".", 1)[0] == name]:
+                    del self.values[key]
+                    removed.append(key)
+            subscribers = list(self.subscribers)
+
+        if changed or removed:
+            for subscriber in subscribers:
+                subscriber.post(changed, removed)
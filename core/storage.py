@@ -24,6 +24,25 @@ The `./data/` storage area provides a consistently structured storage
 space for measurement data. Modules can request the current data-path or
 a filename to save to by calling :meth:`~core.storage.Storage.data`.
 
+Modules which do not want to block while writing their data can pass it
+to :meth:`~core.storage.Storage.write` instead, which writes it on a
+background thread (see :mod:`core.dataWriter`) and returns a handle.
+
+If `deduplicateStatus="true"` is set on the `storage` element of the XML
+configuration, the header of these files only contains a reference to
+the status instead of the complete status, which is stored once in the
+data path (see :mod:`lib.statusStore`). Modules which write files
+themselves can obtain a matching header from
+:meth:`~core.storage.Storage.statusHeader`.
+
+All files written this way are recorded in a catalog in the data path
+(see :mod:`core.catalog`), which can be searched with
+:meth:`~core.storage.Storage.query`.
+
+Large measurements can be stored next to these paths in the binary
+columnar format provided by :func:`lib.data.save`, which allows analysis
+scripts to memory-map individual columns with :func:`lib.data.loadBinary`.
+
 ------
 static
 ------
@@ -34,9 +53,11 @@ of the configuration, but not measurement data. One example are the
 compensation matrices for the :class:`~microMotion.microMotion` module.
 
 Static data is not restricted to any single type of file format. In
-many cases, the :mod:`pickle` module is utilized. This allows modules to keep
-e.g. a settings history by storing settings dictionaries in a list,
-which is then pickled and stored.
+many cases, the :mod:`pickle` module is utilized. Histories, e.g. of
+settings, should be kept in a :class:`~core.history.HistoryStore` obtained
+from :meth:`~core.storage.Storage.history`, which appends entries instead
+of rewriting the complete history and can look up the entry valid at any
+point in time.
 
 In contrast to the XML configuration file accessed through
 :class:`~core.config.XMLConfig`, the `./static/` structure is
@@ -48,6 +69,14 @@ import logging
 import os
 import time
 
+import numpy as np
+
+from catalog import Catalog
+from dataWriter import DataWriter, encodeStatus
+from history import HistoryStore
+from lib.statusStore import StatusStore
+from metrics import registry as metrics
+
 
 class Storage:
     def __init__(self, dataPath="data"):
@@ -67,6 +96,23 @@ class Storage:
                 dataPath = "data"
         self.dataPath = dataPath
 
+        self.writer = DataWriter()
+        self.writer.start()
+
+        self.histories = {}  # path -> HistoryStore
+
+        # optionally store each distinct status only once instead of
+        # writing it to the header of every file
+        self.statusStore = StatusStore(self.dataPath)
+        self.deduplicateStatus = False
+
+        try:
+            self.catalog = Catalog(self.dataPath)
+        except Exception as e:
+            self.logger.error("Failed to open the catalog of '%s': %s",
+                              self.dataPath, e)
+            self.catalog = None
+
     def data(self, moduleName, fileName=None):
         """Generate a filename to save data to."""
         path = "%s/%s" % (self.dataPath, time.strftime("%Y%m%d"))
@@ -82,6 +128,108 @@ class Storage:
         self.logger.debug("%s" % path)
         return path
 
+    def write(self, moduleName, data, status=None, fileName=None,
+              extension=".txt", fmt="%.18e", delimiter=" ", compression=None,
+              columns=None):
+        """Write *data* with *status* as header on a background thread.
+
+        The file is placed at the path returned by :meth:`data` with
+        *extension* and, if *compression* is `"gzip"` or `"zstd"`, the
+        extension of the compression appended. *fmt* and *delimiter* are
+        passed to `np.savetxt`. The names of the *columns* are recorded in
+        the catalog and default to `col0`, `col1`, ...
+
+        Returns a :class:`~core.dataWriter.WriteHandle`, whose `path` is
+        the path of the file and whose :meth:`~core.dataWriter.WriteHandle.wait`
+        method blocks until it is on disk.
+        """
+        path = self.data(moduleName, fileName) + extension
+        # the catalog is updated once the file is written, when the
+        # caller may already have changed the status
+        status = encodeStatus(status)
+        # time spent on the calling thread, which blocks if the queue is full
+        with metrics.timer("storage.enqueue"):
+            handle = self.writer.put(
+                path, data, status, fmt=fmt, delimiter=delimiter,
+                compression=compression,
+                statusStore=self.statusStore if self.deduplicateStatus
+                else None)
+
+        if columns is None:
+            shape = np.shape(data)
+            columns = ["col%d" % i
+                       for i in range(shape[1] if len(shape) > 1 else 1)]
+        else:
+            columns = list(columns)
+
+        def register(handle):
+            if handle.error is None:
+                self.register(handle.path, moduleName, status, columns)
+
+        handle.addCallback(register)
+        return handle
+
+    def statusHeader(self, status):
+        """Return the header to be written to a file with *status*.
+
+        The header is a JSON string. If :attr:`deduplicateStatus` is set,
+        it is a reference to the status in the
+        :class:`~lib.statusStore.StatusStore` of the data path, otherwise
+        the status itself. Both variants are read by :func:`lib.data.load`.
+        """
+        status = encodeStatus(status)
+        if not status:
+            return "{}"
+        if not self.deduplicateStatus:
+            return status
+        return self.statusStore.header(status)
+
+    def register(self, path, moduleName, status=None, columns=None):
+        """Record the measurement file *path* in the catalog.
+
+        Modules which write files themselves should call this method
+        afterwards to make them available to :meth:`query`.
+        """
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.add(path, moduleName, status, columns)
+        except Exception as e:
+            self.logger.error("Failed to add '%s' to the catalog: %s",
+                              path, e)
+
+    def query(self, **criteria):
+        """Return the measurement files matching *criteria*.
+
+        See :meth:`core.catalog.Catalog.query`.
+        """
+        if self.catalog is None:
+            return []
+        return self.catalog.query(**criteria)
+
+    def flush(self, timeout=None):
+        """Wait until all data passed to :meth:`write` is on disk."""
+        start = time.time()
+        if not self.writer.flush(timeout):
+            self.logger.error("Timeout while writing data.")
+        elif time.time() - start > 0.1:
+            self.logger.info("Waited %.1f s for data to be written.",
+                             time.time() - start)
+
+    def stats(self):
+        """Return statistics of the background writer."""
+        return self.writer.stats()
+
+    def history(self, moduleName, name="history"):
+        """Return the :class:`~core.history.HistoryStore` *name* of module
+        *moduleName*, which is stored in `static/<moduleName>/<name>/`."""
+        path = os.path.join(self.static(moduleName), name)
+        try:
+            return self.histories[path]
+        except KeyError:
+            store = self.histories[path] = HistoryStore(path)
+            return store
+
     def static(self, moduleName, fileName=None):
         """Generate a path for static data."""
         path = "static/%s" % moduleName
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Atomically replace files.
+
+Files which must never be seen half-written (configuration, journals,
+measurements) are written to a temporary file first, which then replaces
+the original with :func:`replace`. On POSIX systems, this is a plain
+`os.rename`. On Windows, `os.rename` does not replace existing files, and
+removing the target first leaves a moment without any file, so
+`MoveFileExW` is used instead.
+"""
+import ctypes
+import os
+import sys
+
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+if os.name == "nt":
+    _moveFileEx = ctypes.windll.kernel32.MoveFileExW
+    _moveFileEx.argtypes = (ctypes.c_wchar_p, ctypes.c_wchar_p,
+                            ctypes.c_uint32)
+    _moveFileEx.restype = ctypes.c_int
+
+
+def _unicode(path):
+    if isinstance(path, bytes):
+        return path.decode(sys.getfilesystemencoding())
+    return path
+
+
+def replace(source, target):
+    """Rename *source* to *target*, atomically replacing *target* if it
+    exists.
+
+    Raises :class:`OSError` on failure.
+    """
+    if os.name != "nt":
+        os.rename(source, target)
+        return
+    if not _moveFileEx(_unicode(source), _unicode(target),
+                       MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
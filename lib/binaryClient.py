@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Client for the binary remote interface of EFrame.
+
+Methods are called the same way as through `xmlrpclib.ServerProxy`, but
+over a single persistent connection:
+
+.. code-block:: python
+
+   from lib.binaryClient import EFrameClient
+
+   with EFrameClient("localhost:8001") as eframe:
+       eframe.pmtCounter.setIntegrationTime(100)
+       counts = eframe.pmtCounter.getLastCounts()  # numpy array
+"""
+import itertools
+import socket
+import threading
+
+from lib import binaryProtocol as protocol
+
+
+class RemoteError(Exception):
+    """A request failed on the server.
+
+    The name of the exception raised on the server is available as
+    *type*.
+    """
+
+    def __init__(self, message, type_=None):
+        super(RemoteError, self).__init__(message)
+        self.type = type_
+
+
+class _Method(object):
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._client, "%s.%s" % (self._name, name))
+
+    def __call__(self, *params):
+        return self._client.call(self._name, *params)
+
+
+class EFrameClient(object):
+    """Connect to a :class:`~core.binaryServer.BinaryServer` at *address*.
+
+    *address* is either `host:port` or the path of a Unix-domain socket.
+    The client can be shared between threads, but requests are sent one
+    at a time.
+    """
+
+    def __init__(self, address, timeout=60.0):
+        family, address = protocol.parseAddress(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Method(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, method, *params):
+        """Call *method* (e.g. `"pmtCounter.getCounts"`) with *params*."""
+        with self._lock:
+            requestId = next(self._ids)
+            protocol.send(self._sock, {"id": requestId, "method": method,
+                                       "params": list(params)})
+            response = protocol.receive(self._sock)
+        if response.get("id") != requestId:
+            raise protocol.ProtocolError("Got response to request %s "
+                                         "instead of %s."
+                                         % (response.get("id"), requestId))
+        if "error" in response:
+            raise RemoteError(response["error"], response.get("type"))
+        return response.get("result")
+
+    def multicall(self, calls):
+        """Execute *calls*, a list of `(method, params)`, in one request.
+
+        See :meth:`~core.state.State.multicall`.
+        """
+        return self.call("multicall", [{"methodName": method,
+                                         "params": list(params)}
+                                        for method, params in calls])
+
+    def close(self):
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+
+
+class StatusStream(object):
+    """Subscribe to status changes at a
+    :class:`~core.statusPublisher.StatusPublisher` on *address*.
+
+    Iterating over the stream yields the update messages:
+
+    .. code-block:: python
+
+       stream = StatusStream("/tmp/eframe-status", modules=["laser"],
+                             rate=2)
+       for update in stream:
+           for key, (value, timestamp) in update["values"].items():
+               print(key, value)
+    """
+
+    def __init__(self, address, modules=None, keys=None, rate=10):
+        family, address = protocol.parseAddress(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(address)
+        self.subscribe(modules, keys, rate)
+
+    def subscribe(self, modules=None, keys=None, rate=10):
+        """Replace the subscription by *modules* and *keys*."""
+        protocol.send(self._sock, {"subscribe": {"modules": modules,
+                                                 "keys": keys,
+                                                 "rate": rate}})
+
+    def receive(self):
+        """Wait for and return the next update."""
+        return protocol.receive(self._sock)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.receive()
+            except EOFError:
+                return
+
+    def close(self):
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
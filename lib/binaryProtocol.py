@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Binary framing for the persistent-connection remote interface.
+
+Every message is a msgpack-encoded object preceded by its length as a
+4-byte big-endian unsigned integer. Numpy arrays are sent as a msgpack
+extension type containing the dtype, the shape and the raw array data,
+so they are transferred without text encoding.
+
+A request is a dictionary `{"id": ..., "method": ..., "params": [...]}`,
+the response to it either `{"id": ..., "result": ...}` or
+`{"id": ..., "error": ..., "type": ...}`.
+"""
+import select
+import socket
+import struct
+import time
+
+import msgpack
+import numpy as np
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = 256 * 1024 * 1024  # bytes
+NDARRAY = 1  # msgpack extension type code
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class DecodeError(ProtocolError):
+    """A complete frame was received, but its content is invalid."""
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        array = np.ascontiguousarray(obj)
+        return msgpack.ExtType(NDARRAY, msgpack.packb(
+            [array.dtype.str, list(array.shape), array.tobytes()],
+            use_bin_type=True))
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Cannot serialize object of type %s."
+                    % type(obj).__name__)
+
+
+def _extHook(code, data):
+    if code == NDARRAY:
+        dtype, shape, buf = msgpack.unpackb(data, raw=False)
+        return np.frombuffer(buf, dtype=np.dtype(dtype)).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+def encode(obj):
+    """Return the frame for *obj*, including its length prefix."""
+    payload = msgpack.packb(obj, default=_default, use_bin_type=True)
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode(payload):
+    """Return the object contained in *payload* (without length prefix).
+
+    Raises :class:`DecodeError` if *payload* is not valid.
+    """
+    try:
+        return msgpack.unpackb(payload, ext_hook=_extHook, raw=False)
+    except Exception as e:
+        raise DecodeError("Invalid frame: %s: %s"
+                          % (e.__class__.__name__, e))
+
+
+def _receive(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError("Connection closed.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _sendAll(sock, data, timeout):
+    deadline = time.time() + timeout
+    view = memoryview(data)
+    while view:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([], [sock], [], remaining)[1]:
+            raise socket.timeout("Timeout after %s s while sending." % timeout)
+        view = view[sock.send(view[:64 * 1024]):]
+
+
+def send(sock, obj, timeout=None):
+    """Send *obj* as a single frame over *sock*.
+
+    If *timeout* is given, :class:`socket.timeout` is raised if the frame
+    could not be sent within *timeout* seconds. Unlike
+    :meth:`socket.socket.settimeout`, this does not affect receiving.
+    """
+    if timeout is None:
+        sock.sendall(encode(obj))
+    else:
+        _sendAll(sock, encode(obj), timeout)
+
+
+def receive(sock):
+    """Receive a single frame from *sock* and return its content.
+
+    Raises :class:`EOFError` if the connection was closed.
+    """
+    size, = HEADER.unpack(_receive(sock, HEADER.size))
+    if size > MAX_FRAME:
+        raise ProtocolError("Frame of %d bytes exceeds the limit of %d "
+                            "bytes." % (size, MAX_FRAME))
+    return decode(_receive(sock, size))
+
+
+def parseAddress(address):
+    """Return the socket family and address for *address*.
+
+    *address* is either `host:port` (TCP) or, on platforms which support
+    them, the path of a Unix-domain socket. On other platforms (i.e.
+    Windows), a bare port number is accepted as well.
+    """
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "localhost", int(port))
+    if hasattr(socket, "AF_UNIX"):
+        return socket.AF_UNIX, address
+    if address.isdigit():
+        return socket.AF_INET, ("localhost", int(address))
+    raise ValueError("Unix-domain sockets are not supported on this "
+                     "platform, use 'host:port' instead of '%s'." % address)
@@ -13,23 +13,314 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-"""Helper methods for handling data produced by EFrame modules."""
-import numpy as np
+"""Helper methods for handling data produced by EFrame modules.
+
+Besides text files written by `np.savetxt`, measurements can be stored in
+a binary columnar format: a directory with the extension
+:data:`BINARY_EXTENSION` which contains every column as a `.npy` file
+and a `meta.json` file with the column names and the status. Columns are
+loaded as memory-mapped arrays, so opening even very large files is
+instantaneous and only the columns which are actually used are read.
+
+Text files are parsed in a single pass and in chunks of a fixed number of
+lines (see :func:`iterload`). :func:`load` can keep the parsed data in a
+binary sidecar file (with the extension :data:`CACHE_EXTENSION`), which is
+used as long as the size and modification time of the text file match.
+
+If the header of a text file only references a status stored in the
+data path (see :mod:`lib.statusStore`), the status is loaded from there.
+"""
+import gzip
+import io
 import json
+import os
+import shutil
+
+import numpy as np
+
+from lib import statusStore
+
+BINARY_EXTENSION = ".cols"
+BINARY_VERSION = 1
+CACHE_EXTENSION = ".cache"
+CHUNKSIZE = 100000  # lines
+
+
+class Columns(list):
+    """List of the columns of a measurement with their *names*.
+
+    Columns can be accessed by index or through :meth:`column` by name.
+    """
+
+    def __init__(self, columns, names):
+        super(Columns, self).__init__(columns)
+        self.names = list(names)
+
+    def column(self, name):
+        """Return the column *name*."""
+        return self[self.names.index(name)]
+
+
+def load(filename, usecols=None, comments="#", header_lines=0, cache=False):
+    """Load data and status from a text file as produced by EFrame modules.
+
+    The last *header_lines* lines of the header are not part of the status.
+    If *cache* is `True`, the parsed file is stored in a binary sidecar file
+    which is used by subsequent calls until the text file changes.
+    """
+    if cache:
+        try:
+            return _loadCache(filename, usecols, comments, header_lines)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        # all columns are cached, so they are selected after loading
+        status, chunks = iterload(filename, comments=comments,
+                                  header_lines=header_lines)
+        columns = _concatenate(chunks)
+        try:
+            _writeCache(filename, columns, status, comments, header_lines)
+        except (IOError, OSError):
+            pass  # e.g. no write access to the data directory
+        if usecols is not None and columns.size:
+            columns = np.take(columns, usecols, axis=0)
+        return _squeeze(columns), status
+
+    status, chunks = iterload(filename, usecols=usecols, comments=comments,
+                              header_lines=header_lines)
+    return _squeeze(_concatenate(chunks)), status
+
+
+def _concatenate(chunks):
+    """Return the columns of all *chunks* as a single 2D array."""
+    chunks = list(chunks)
+    if not chunks:
+        return np.empty((0, 0))
+    return np.concatenate(chunks, axis=1)
+
+
+def _squeeze(columns):
+    if not columns.size:
+        return np.array([])
+    return np.squeeze(columns)
+
+
+def iterload(filename, usecols=None, comments="#", header_lines=0,
+             chunksize=CHUNKSIZE):
+    """Load a text file as produced by EFrame modules in chunks.
+
+    Returns the status and a generator which yields the data in chunks of
+    at most *chunksize* lines. Like the data returned by :func:`load`,
+    each chunk is a two-dimensional array with one row per column.
+    """
+    datafile = _open(filename)
+    try:
+        header = []
+        firstLine = None
+        for line in datafile:
+            if line.startswith(comments):
+                header.append(line.lstrip(comments).rstrip())
+            elif line.strip():
+                firstLine = line
+                break
+    except Exception:
+        datafile.close()
+        raise
+
+    try:
+        status = statusStore.resolve(_parseHeader(header, header_lines),
+                                     filename)
+    except Exception:
+        datafile.close()
+        raise
+    return (status,
+            _iterChunks(datafile, firstLine, usecols, comments, chunksize))
+
+
+def loadHeader(filename, comments="#", header_lines=0):
+    """Return the status and the number of columns of a text file as
+    produced by EFrame modules without loading its data."""
+    with _open(filename) as datafile:
+        header = []
+        columns = 0
+        for line in datafile:
+            if line.startswith(comments):
+                header.append(line.lstrip(comments).rstrip())
+            elif line.strip():
+                columns = len(line.split())
+                break
+    return statusStore.resolve(_parseHeader(header, header_lines),
+                               filename), columns
 
 
-def load(filename, usecols=None, comments="#", header_lines=0):
-    """Load data and status from a text file as produced by EFrame modules."""
-    with open(filename, "r") as datafile:
-        header = [line.lstrip("%s" % comments).rstrip()
-                  for line in datafile if line[0] == comments]
+def _open(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "r")
+    if filename.endswith(".zst"):
+        import zstandard  # only required for zstd-compressed files
+        with open(filename, "rb") as f:
+            content = zstandard.ZstdDecompressor().decompressobj().decompress(
+                f.read())
+        return io.BytesIO(content)
+    return open(filename, "r")
 
+
+def _parseHeader(header, header_lines=0):
     try:
-        status = json.loads("".join(header[:-header_lines]))
+        return json.loads("".join(header[:len(header) - header_lines]))
     except ValueError:
+        return {}
+
+
+def _iterChunks(datafile, firstLine, usecols, comments, chunksize):
+    try:
+        if firstLine is None:
+            return
+        lines = [firstLine]
+        for line in datafile:
+            lines.append(line)
+            if len(lines) >= chunksize:
+                yield _parseChunk(lines, usecols, comments)
+                lines = []
+        if lines:
+            yield _parseChunk(lines, usecols, comments)
+    finally:
+        datafile.close()
+
+
+def _parseChunk(lines, usecols, comments):
+    return np.transpose(np.loadtxt(lines, usecols=usecols, comments=comments,
+                                   ndmin=2))
+
+
+def _cacheSource(filename):
+    stat = os.stat(filename)
+    return {"path": os.path.abspath(filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime}
+
+
+def _loadCache(filename, usecols, comments, header_lines):
+    path = filename + CACHE_EXTENSION
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    source = meta["source"]
+    current = _cacheSource(filename)
+    if source["size"] != current["size"] or \
+            source["mtime"] != current["mtime"] or \
+            source["comments"] != comments or \
+            source["header_lines"] != header_lines:
+        raise ValueError("Cache for '%s' is outdated." % filename)
+
+    columns, status = loadBinary(path, usecols=usecols, mmap=False)
+    if not columns:
+        return np.array([]), status
+    return np.squeeze(np.array(columns)), status
+
+
+def _writeCache(filename, columns, status, comments, header_lines):
+    source = _cacheSource(filename)
+    source["comments"] = comments
+    source["header_lines"] = header_lines
+    save(filename + CACHE_EXTENSION, list(columns), status,
+         meta={"source": source})
+
+
+def binaryPath(path):
+    """Return *path* with the extension of the binary format."""
+    if path.endswith(BINARY_EXTENSION):
+        return path
+    return path + BINARY_EXTENSION
+
+
+def save(path, columns, status=None, names=None, meta=None):
+    """Save *columns* and *status* in the binary columnar format.
+
+    *columns* is either a sequence of one-dimensional arrays or a
+    two-dimensional array with one column per row (as returned by
+    :func:`load`). *status* is a dictionary or a JSON string as returned by
+    :meth:`~core.state.State.getStatus`. If no column *names* are given,
+    the columns are named `col0`, `col1`, etc. Entries of the dictionary
+    *meta* are stored in `meta.json` in addition to the names and status.
+
+    Returns the path of the written file.
+    """
+    if not path.endswith(CACHE_EXTENSION):
+        path = binaryPath(path)
+    columns = [np.asarray(column) for column in columns]
+    if names is None:
+        names = ["col%d" % i for i in range(len(columns))]
+    elif len(names) != len(columns):
+        raise ValueError("Got %d column names for %d columns."
+                         % (len(names), len(columns)))
+
+    if status is None:
         status = {}
-        
-    data = np.loadtxt(filename, usecols=usecols, comments=comments)
-    data = np.transpose(data)
+    elif isinstance(status, basestring):
+        status = json.loads(status)
+
+    # write to a temporary directory first, so that readers never
+    # see a partially written file
+    tmpPath = path + ".tmp"
+    if os.path.exists(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.mkdir(tmpPath)
+    for i, column in enumerate(columns):
+        np.save(os.path.join(tmpPath, "%d.npy" % i), column)
+    meta = dict(meta or {})
+    meta.update({"version": BINARY_VERSION,
+                 "columns": list(names),
+                 "status": status})
+    with open(os.path.join(tmpPath, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmpPath, path)
+    return path
+
+
+def loadBinary(path, usecols=None, mmap=True):
+    """Load data and status from a file in the binary columnar format.
+
+    *usecols* selects columns by index or by name. Unless *mmap* is
+    `False`, the columns are memory-mapped and only read from disk when
+    accessed.
+
+    Returns a :class:`Columns` list and the status dictionary.
+    """
+    if not path.endswith(CACHE_EXTENSION):
+        path = binaryPath(path)
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    names = meta["columns"]
+    if usecols is None:
+        indices = range(len(names))
+    else:
+        if isinstance(usecols, (int, basestring)):
+            usecols = [usecols]
+        indices = [names.index(col) if isinstance(col, basestring) else col
+                   for col in usecols]
+
+    mode = "r" if mmap else None
+    columns = [np.load(os.path.join(path, "%d.npy" % i), mmap_mode=mode)
+               for i in indices]
+    return Columns(columns, [names[i] for i in indices]), meta["status"]
+
+
+def convert(filename, target=None, names=None, comments="#",
+            header_lines=0):
+    """Convert a text file as produced by EFrame modules to binary format.
 
-    return data, status
+    The converted file is written to *target*, which defaults to
+    *filename* with its extension replaced by :data:`BINARY_EXTENSION`.
+    Returns the path of the written file.
+    """
+    if target is None:
+        target = os.path.splitext(filename)[0]
+    data, status = load(filename, comments=comments,
+                        header_lines=header_lines)
+    if data.ndim == 1:
+        data = [data]
+    return save(target, data, status, names=names)
@@ -13,12 +13,284 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+"""Write measurements and events to EFrame's InfluxDB database.
+
+By default, every point is written synchronously on the calling thread.
+In *buffered* mode, points are instead handed to a :class:`BufferedWriter`,
+which collects them in a bounded queue and writes them in batches from a
+background thread. This keeps HTTP round trips off the GUI thread.
+"""
+import collections
+import logging
+import threading
+import time
+
 import influxdb
 
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+
+
+class BufferedWriter(threading.Thread):
+    """Write points to InfluxDB in batches from a background thread.
+
+    A batch is written as soon as *batchSize* points are queued or
+    *flushInterval* seconds after the first point of the batch was queued,
+    whichever comes first.
+
+    If the queue holds *maxQueueSize* points, the *overflow* policy decides
+    what happens to new points: :data:`DROP_OLDEST` discards the oldest
+    queued point, :data:`BLOCK` blocks the caller until there is space.
+
+    A batch which could not be written is retried up to *maxRetries* times,
+    waiting *retryInterval* seconds longer before every attempt. Further
+    points queue up meanwhile.
+    """
+
+    def __init__(self, client, batchSize=500, flushInterval=1.0,
+                 maxQueueSize=10000, overflow=DROP_OLDEST, maxRetries=3,
+                 retryInterval=1.0):
+        super(BufferedWriter, self).__init__(name="InfluxWriter")
+        self.daemon = True
+        self.logger = logging.getLogger("Influx.BufferedWriter")
+
+        if overflow not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown overflow policy '%s'." % overflow)
+
+        self.client = client
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxQueueSize = maxQueueSize
+        self.overflow = overflow
+        self.maxRetries = maxRetries
+        self.retryInterval = retryInterval  # s
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._inFlight = 0
+        self._flushRequested = False
+        self._stopRequested = False
+
+        # counters
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.lastBatchSize = 0
+        self.lastLatency = 0.0  # ms
+        self.totalLatency = 0.0  # ms
+
+    def put(self, point):
+        """Queue a single *point* for writing."""
+        with self._condition:
+            if self._stopRequested:
+                self.logger.warning("Writer was stopped, dropping point.")
+                self.dropped += 1
+                return
+            while len(self._queue) >= self.maxQueueSize:
+                if self.overflow == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait()
+            self._queue.append(point)
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Write all queued points and wait until they are written.
+
+        Returns `False` if the queue could not be emptied within
+        *timeout* seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._flushRequested = True
+            self._condition.notify_all()
+            try:
+                while self._queue or self._inFlight:
+                    if deadline is None:
+                        self._condition.wait(0.1)
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self._condition.wait(min(remaining, 0.1))
+            finally:
+                self._flushRequested = False
+        return True
+
+    def stop(self, timeout=5.0):
+        """Flush all queued points and stop the thread within *timeout*
+        seconds."""
+        deadline = time.time() + timeout
+        flushed = self.flush(timeout)
+        if not flushed:
+            self.logger.error("Could not write %d points before shutdown.",
+                              len(self._queue))
+        with self._condition:
+            self._stopRequested = True
+            self._condition.notify_all()
+        self.join(max(0.0, deadline - time.time()))
+
+    def stats(self):
+        """Return a dictionary with the writer's counters."""
+        with self._condition:
+            return {"queueDepth": len(self._queue),
+                    "written": self.written,
+                    "dropped": self.dropped,
+                    "failed": self.failed,
+                    "retried": self.retried,
+                    "batches": self.batches,
+                    "lastBatchSize": self.lastBatchSize,
+                    "lastLatency": self.lastLatency,
+                    "meanLatency": (self.totalLatency / self.batches
+                                    if self.batches else 0.0)}
+
+    def run(self):
+        retry = None  # (batch, attempts) of a failed batch
+        while True:
+            with self._condition:
+                if retry is not None:
+                    batch, attempts = retry
+                    deadline = time.time() + self.retryInterval * attempts
+                    while not self._stopRequested:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    retry = None
+                else:
+                    batch = self._nextBatch()
+                    if batch is None:
+                        return
+                    attempts = 0
+
+            size = len(batch)
+            start = time.time()
+            try:
+                self.client.write_points(batch)
+            except Exception as e:
+                success = False
+                error = "%s: %s" % (e.__class__.__name__, e)
+            else:
+                success = True
+            latency = (time.time() - start) * 1000  # duration in ms
+
+            with self._condition:
+                if success:
+                    self.written += size
+                    self.batches += 1
+                    self.lastBatchSize = size
+                    self.lastLatency = latency
+                    self.totalLatency += latency
+                elif attempts < self.maxRetries and not self._stopRequested:
+                    self.logger.warning("Failed to write %d points, retrying "
+                                        "in %.1f s: %s", size,
+                                        self.retryInterval * (attempts + 1),
+                                        error)
+                    self.retried += size
+                    retry = (batch, attempts + 1)
+                    continue  # the batch stays in flight
+                else:
+                    self.logger.error("Failed to write %d points: %s",
+                                      size, error)
+                    self.failed += size
+                self._inFlight = 0
+                self._condition.notify_all()
+
+    def _nextBatch(self):
+        """Wait for the next batch and return it, or `None` once stopped.
+
+        Needs to be called with the condition held.
+        """
+        batchStart = None
+        while True:
+            if self._stopRequested and not self._queue:
+                return None
+            if self._queue and batchStart is None:
+                batchStart = time.time()
+            if len(self._queue) >= self.batchSize or \
+                    (self._queue and (self._flushRequested or
+                                      self._stopRequested)):
+                break
+            if batchStart is None:
+                self._condition.wait()
+            else:
+                remaining = batchStart + self.flushInterval - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+        size = min(len(self._queue), self.batchSize)
+        batch = [self._queue.popleft() for _ in range(size)]
+        self._inFlight = size
+        self._condition.notify_all()  # wake up blocked callers
+        return batch
+
 
 class Influx(object):
-    def __init__(self):
+    """Write data points to the `eframe` InfluxDB database.
+
+    If *buffered* is `True`, points are written by a :class:`BufferedWriter`
+    instead of synchronously. Additional keyword arguments are passed on
+    to the writer.
+    """
+
+    def __init__(self, buffered=False, **writerOptions):
+        self.logger = logging.getLogger("Influx")
         self.influx = influxdb.InfluxDBClient(database="eframe")
+        self.writer = None
+        if buffered:
+            self.enableBuffering(**writerOptions)
+
+    def enableBuffering(self, **writerOptions):
+        """Write points through a background :class:`BufferedWriter`."""
+        if self.writer is not None:
+            self.logger.warning("Buffered writing is already enabled.")
+            return
+        self.writer = BufferedWriter(self.influx, **writerOptions)
+        self.writer.start()
+        self.logger.info("Enabled buffered writing to InfluxDB.")
+
+    def disableBuffering(self, timeout=5.0):
+        """Write all queued points and return to synchronous writing.
+
+        Points which cannot be written within *timeout* seconds are lost.
+        """
+        if self.writer is not None:
+            writer = self.writer
+            self.writer = None
+            writer.stop(timeout)
+            self.logger.info("Disabled buffered writing to InfluxDB.")
+
+    def flush(self, timeout=5.0):
+        """Write all queued points (if buffered) and wait for completion."""
+        if self.writer is not None:
+            if not self.writer.flush(timeout):
+                self.logger.error("Timeout while flushing queued points.")
+
+    def close(self, timeout=1.0):
+        """Flush all queued points and stop the background writer.
+
+        Waits at most *timeout* seconds, as this is called while the GUI
+        is closing.
+        """
+        self.disableBuffering(timeout)
+
+    def stats(self):
+        """Return the counters of the background writer (if buffered)."""
+        if self.writer is None:
+            return {}
+        return self.writer.stats()
+
+    def write(self, points):
+        """Write a list of raw InfluxDB *points*."""
+        if self.writer is None:
+            self.influx.write_points(points)
+        else:
+            for point in points:
+                self.writer.put(point)
 
     def message(self, title, text, type_):
         """Write a message which can be displayed as an event in Grafana."""
@@ -26,7 +298,7 @@ class Influx(object):
                    "fields": {"title": title, "message": text},
                    "tags": {"type": type_}
                    }
-        self.influx.write_points([message])
+        self.write([message])
 
     def measurement(self, measurement, value, unit, module, tags=None):
         """Write a single measurement point.
@@ -39,7 +311,7 @@ class Influx(object):
                    "tags": {"unit": unit, "module": module}}
         if tags is not None:
             message["tags"].update(tags)
-        self.influx.write_points([message])
+        self.write([message])
 
     def custom(self, measurement, fields, tags, module):
         """Write a custom data point.
@@ -51,4 +323,4 @@ class Influx(object):
                    "fields": fields,
                    "tags": tags}
         message["tags"]["module"] = module
-        self.influx.write_points([message])
+        self.write([message])
@@ -17,42 +17,249 @@
 
 Based on
 https://stackoverflow.com/questions/21102293/how-to-write-to-kafka-from-python-logging-module
+
+Records are formatted on the logging thread and handed to a dedicated
+sender thread through a bounded queue, so logging never waits for the
+broker. While the broker is unreachable, records are appended to a spool
+file. The sender reconnects with exponential backoff and replays the
+spool once the connection is back.
 """
+import collections
+import json
 import logging
+import os
+import Queue
+import threading
+import time
+
 from kafka import KafkaProducer
 
 
 class KafkaLoggingHandler(logging.Handler):
 
-    def __init__(self, servers, topic):
+    def __init__(self, servers, topic, maxQueueSize=10000,
+                 spoolPath="log/kafka.spool", maxSpoolSize=10000000,
+                 minBackoff=1.0, maxBackoff=300.0):
         logging.Handler.__init__(self)
+        self.servers = servers
         self.topic = topic
         self.logger = logging.getLogger("KafkaLoggingHandler")
+
+        self.spoolPath = spoolPath
+        self.maxSpoolSize = maxSpoolSize  # bytes
+        self.minBackoff = minBackoff  # s
+        self.maxBackoff = maxBackoff  # s
+        self.backoff = minBackoff
+        self.nextAttempt = 0
+
+        # the producer is only replaced by the sender thread
+        self.producer = None
+        self.producerLock = threading.Lock()
+        self.queue = Queue.Queue(maxQueueSize)
+        self.spoolLock = threading.Lock()
+        self.counterLock = threading.Lock()
+
+        # counters
+        self.queued = 0
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+        self.replayed = 0
+
+        # records whose delivery failed, reported on kafka's I/O thread
+        self._failed = collections.deque()
+        self._sendFailed = threading.Event()
+
+        self._stopEvent = threading.Event()
+        self._sender = threading.Thread(target=self._run,
+                                        name="KafkaSender")
+        self._sender.daemon = True
+        self._sender.start()
+
+    @property
+    def active(self):
+        """`True` while connected to the broker."""
+        return self.producer is not None
+
+    def stats(self):
+        """Return a dictionary with the handler's counters."""
+        with self.counterLock:
+            return {"queued": self.queued,
+                    "sent": self.sent,
+                    "spooled": self.spooled,
+                    "dropped": self.dropped,
+                    "replayed": self.replayed,
+                    "queueDepth": self.queue.qsize(),
+                    "connected": self.active}
+
+    def _count(self, counter, n=1):
+        with self.counterLock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def emit(self, record):
+        # drop kafka logging and our own messages to avoid infinite recursion
+        if record.name.startswith("kafka") or record.name == self.logger.name:
+            return
+
         try:
-            self.producer = KafkaProducer(bootstrap_servers=servers)
-        except Exception as e:
-            self.active = False
-            self.logger.warning("Could not establish connection to server.")
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            self._count("dropped")
         else:
-            self.active = True
+            self._count("queued")
 
-    def emit(self, record):
-        if record.name == 'kafka':
-            return  # drop kafka logging to avoid infinite recursion
+    def _run(self):
+        while not (self._stopEvent.isSet() and self.queue.empty()):
+            try:
+                msg = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                msg = None
 
-        if self.active:
             try:
-                msg = self.format(record)
-                self.producer.send(topic=self.topic, value=msg)
+                self._handleSendErrors()
+                if self.producer is None and not self._stopEvent.isSet() \
+                        and time.time() >= self.nextAttempt:
+                    if self._connect():
+                        self._replaySpool()
+
+                if msg is not None:
+                    if self.producer is not None:
+                        self._send(msg)
+                    else:
+                        self._spool([msg])
             except Exception as e:
-                self.active = False
-                self.logger.error("Sending record failed. Stopping.")
+                # records must not pile up in the queue because the sender
+                # thread died
+                self.logger.error("Failed to send record: %s", e)
 
-    def close(self):
+    def _connect(self):
         try:
-            self.producer.close()
-        except AttributeError:
-            pass
+            producer = KafkaProducer(bootstrap_servers=self.servers)
+        except Exception as e:
+            self.logger.warning("Could not establish connection to server, "
+                                "retrying in %d s: %s", self.backoff, e)
+            self.nextAttempt = time.time() + self.backoff
+            self.backoff = min(2 * self.backoff, self.maxBackoff)
+            return False
+        else:
+            with self.producerLock:
+                self.producer = producer
+            self.logger.info("Connected to Kafka broker.")
+            self.backoff = self.minBackoff
+            return True
+
+    def _disconnect(self):
+        with self.producerLock:
+            producer, self.producer = self.producer, None
+        self.nextAttempt = time.time() + self.backoff
+        self.backoff = min(2 * self.backoff, self.maxBackoff)
+        if producer is not None:
+            self.logger.warning("Lost connection to Kafka broker. Spooling "
+                                "records to '%s'.", self.spoolPath)
+            try:
+                producer.close(timeout=0)
+            except Exception:
+                pass
+
+    def _send(self, msg):
+        if isinstance(msg, unicode):
+            msg = msg.encode("utf-8")
+        try:
+            future = self.producer.send(topic=self.topic, value=msg)
+        except Exception:
+            self._disconnect()
+            self._spool([msg])
+        else:
+            future.add_callback(self._onSent)
+            future.add_errback(self._onSendError, msg)
+
+    def _onSent(self, metadata):
+        self._count("sent")
+
+    def _onSendError(self, msg, exception):
+        # called from the producer's I/O thread, the sender thread spools
+        # the record and reconnects
+        self._failed.append(msg)
+        self._sendFailed.set()
+
+    def _spoolFailed(self):
+        failed = []
+        while self._failed:
+            failed.append(self._failed.popleft())
+        if failed:
+            self._spool(failed)
+
+    def _handleSendErrors(self):
+        if not self._sendFailed.isSet():
+            return
+        self._sendFailed.clear()
+        self._spoolFailed()
+        if self.producer is not None:
+            self._disconnect()
+
+    def _spool(self, messages):
+        with self.spoolLock:
+            try:
+                size = os.path.getsize(self.spoolPath)
+            except OSError:
+                size = 0
+            try:
+                with open(self.spoolPath, "a") as f:
+                    for msg in messages:
+                        try:
+                            line = json.dumps(msg) + "\n"
+                        except (TypeError, ValueError):
+                            self._count("dropped")
+                            continue
+                        if size + len(line) > self.maxSpoolSize:
+                            self._count("dropped")
+                            continue
+                        f.write(line)
+                        size += len(line)
+                        self._count("spooled")
+            except IOError:
+                self._count("dropped", len(messages))
+
+    def _replaySpool(self):
+        with self.spoolLock:
+            try:
+                with open(self.spoolPath, "r") as f:
+                    lines = f.readlines()
+                os.remove(self.spoolPath)
+            except (IOError, OSError):
+                return
+
+        messages = []
+        for line in lines:
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                self._count("dropped")
+
+        if messages:
+            self.logger.info("Replaying %d spooled records.", len(messages))
+        for i, msg in enumerate(messages):
+            if self.producer is None or self._sendFailed.isSet():
+                self._spool(messages[i:])
+                break
+            self._send(msg)
+            self._count("replayed")
+
+    def close(self, timeout=5.0):
+        self._stopEvent.set()
+        self._sender.join(timeout)
+        with self.producerLock:
+            producer, self.producer = self.producer, None
+        if producer is not None:
+            producer.flush(timeout)
+            producer.close(timeout)
+        self._spoolFailed()
         logging.Handler.close(self)
 
 
@@ -65,7 +272,4 @@ if __name__ == "__main__":
     logger.info("I am here and you are not.")
     k.close()
     print("Closed")
-    
-    
-    
-    
+    print(k.stats())
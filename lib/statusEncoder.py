@@ -31,3 +31,15 @@ class StatusEncoder(json.JSONEncoder):
             return super(self.__class__, self).default(o)
         except TypeError:
             return str(o)
+
+
+def flatten(status, prefix=""):
+    """Flatten the nested dictionary *status* into `{"a.b.c": value}`."""
+    values = {}
+    for key, value in status.iteritems():
+        path = "%s.%s" % (prefix, key) if prefix else unicode(key)
+        if isinstance(value, dict) and value:
+            values.update(flatten(value, path))
+        else:
+            values[path] = value
+    return values
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Content-addressed storage of status messages.
+
+The status of consecutive measurements is usually identical, and for
+short measurements it is often larger than the data. Instead of
+embedding it in every file, a :class:`StatusStore` stores each distinct
+status once in the directory :data:`STATUS_DIRECTORY` of the data path,
+named by the SHA-1 hash of its canonical JSON encoding, and measurement
+files only contain a reference of the form::
+
+    # {"statusRef": "<hash>"}
+
+:func:`lib.data.load` resolves such references transparently by looking
+for :data:`STATUS_DIRECTORY` in the directories above the measurement
+file.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from lib import atomicFile
+from lib.statusEncoder import StatusEncoder
+
+STATUS_DIRECTORY = ".status"
+REFERENCE_KEY = "statusRef"
+
+
+def canonical(status):
+    """Return the canonical JSON encoding of *status*.
+
+    *status* is a dictionary or a JSON string as returned by
+    :meth:`~core.state.State.getStatus`. Like the latter, dictionaries may
+    contain values which are not serializable (see
+    :class:`~lib.statusEncoder.StatusEncoder`).
+    """
+    if isinstance(status, basestring):
+        status = json.loads(status)
+    return json.dumps(status, sort_keys=True, separators=(",", ":"),
+                      cls=StatusEncoder)
+
+
+def isReference(status):
+    """Return `True` if the parsed header *status* is a reference."""
+    return isinstance(status, dict) and len(status) == 1 \
+        and REFERENCE_KEY in status
+
+
+def findStore(filename):
+    """Return the status directory responsible for *filename* or `None`."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    while True:
+        candidate = os.path.join(directory, STATUS_DIRECTORY)
+        if os.path.isdir(candidate):
+            return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def resolve(status, filename):
+    """Return the status referenced by the parsed header *status* of
+    *filename*, or *status* itself if it is not a reference.
+
+    If the referenced status cannot be found (e.g. because the file was
+    copied without the status directory), a warning is logged and the
+    reference itself is returned.
+    """
+    if not isReference(status):
+        return status
+    directory = findStore(filename)
+    if directory is None:
+        logging.getLogger("StatusStore").warning(
+            "Found no '%s' directory for '%s'.", STATUS_DIRECTORY, filename)
+        return status
+    try:
+        return StatusStore(os.path.dirname(directory)).get(
+            status[REFERENCE_KEY])
+    except (IOError, ValueError) as e:
+        logging.getLogger("StatusStore").warning(
+            "Cannot resolve the status of '%s': %s", filename, e)
+        return status
+
+
+class StatusStore(object):
+    """Store status messages by hash in *dataPath*."""
+
+    def __init__(self, dataPath):
+        self.path = os.path.join(dataPath, STATUS_DIRECTORY)
+        self.lock = threading.Lock()
+        self.known = set()  # hashes which are known to be stored
+        self._last = (None, None)  # (status, hash) of the last put()
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], "%s.json" % digest)
+
+    def put(self, status):
+        """Store *status* (if necessary) and return its hash."""
+        last, digest = self._last
+        # a dictionary may have been modified since the last call, so only
+        # (immutable) strings are compared
+        if not isinstance(status, basestring) or status != last:
+            encoded = canonical(status)
+            digest = hashlib.sha1(encoded).hexdigest()
+            with self.lock:
+                if digest not in self.known:
+                    self._write(digest, encoded)
+                    self.known.add(digest)
+            self._last = (status, digest)
+        return digest
+
+    def _write(self, digest, encoded):
+        path = self._path(digest)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmpPath = "%s.tmp" % path
+        with open(tmpPath, "w") as f:
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        atomicFile.replace(tmpPath, path)
+
+    def header(self, status):
+        """Return the header referencing *status*."""
+        return json.dumps({REFERENCE_KEY: self.put(status)})
+
+    def get(self, digest):
+        """Return the status dictionary with the hash *digest*."""
+        with open(self._path(digest), "r") as f:
+            return json.load(f)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import shutil
+import tempfile
+import time
+import unittest
+
+from core.history import HistoryStore
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = HistoryStore(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def testOlderTimestampIsRejected(self):
+        self.store.append("first", 100.0)
+
+        self.assertRaises(ValueError, self.store.append, "second", 50.0)
+        self.assertEqual(self.store.range(), [(100.0, "first")])
+
+    def testDefaultTimestampDoesNotDecrease(self):
+        # as if the system time was set back by an hour after this entry
+        future = time.time() + 3600
+        self.store.append("first", future)
+
+        self.assertEqual(self.store.append("second"), future)
+        self.assertEqual(self.store.latest(), "second")
+        self.assertEqual(self.store.at(future), "second")
+
+
+if __name__ == "__main__":
+    unittest.main()
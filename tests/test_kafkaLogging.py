@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+#   (c) 2017 Kilian Kluge
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from kafka.errors import KafkaError
+    from kafka.future import Future
+    from lib.kafkaLogging import KafkaLoggingHandler
+except ImportError:
+    KafkaLoggingHandler = None
+
+
+@unittest.skipIf(KafkaLoggingHandler is None, "kafka-python is not installed")
+class TestKafkaLoggingHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spoolPath = os.path.join(self.directory, "kafka.spool")
+        # nothing listens on port 1, so the handler stays disconnected
+        self.handler = KafkaLoggingHandler(["localhost:1"], "test",
+                                           spoolPath=self.spoolPath,
+                                           minBackoff=60.0)
+
+    def tearDown(self):
+        self.handler.close(timeout=10.0)
+        shutil.rmtree(self.directory)
+
+    def spooled(self):
+        with open(self.spoolPath, "r") as f:
+            return [json.loads(line) for line in f]
+
+    def testFailedSendIsSpooled(self):
+        future = Future()
+        future.add_errback(self.handler._onSendError, "record")
+        future.failure(KafkaError("broker went away"))
+        self.handler.close(timeout=10.0)
+
+        self.assertEqual(self.spooled(), ["record"])
+        self.assertFalse(self.handler._sender.is_alive())
+
+    def testUnserializableRecordIsDropped(self):
+        self.handler._spool([object(), "record"])
+
+        self.assertEqual(self.spooled(), ["record"])
+        self.assertEqual(self.handler.stats()["dropped"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,19 +21,32 @@ Based on the example given in `this Stackoverflow post \
 <https://stackoverflow.com/questions/13318742/python-logging-to-tkinter-text-widget>`_.
 
 Written by Kilian Kluge for use in EFrame.
+
+Records are usually emitted from module worker threads. The handler
+therefore only formats them and puts them into a queue. A timer on the GUI
+thread drains the queue and writes each batch to the widget with a single
+edit. The widget's document is a ring buffer of at most *maxBlocks* lines.
+Records that arrive while more than *maxPending* records are waiting are
+dropped, and the number of dropped records is shown in the widget.
 """
+import collections
 import logging
 import logging.handlers
 import sys
-from PyQt4 import QtGui
+import threading
+from PyQt4 import QtGui, QtCore
 
 
 class QTextEditHandler(logging.Handler):
     """Display log messages in a :class:`QtGui.QTextEdit` widget.
 
     :param: textEdit: Instance of :class:`QTextEdit` to log to.
+    :param: maxBlocks: Maximum number of lines kept in the widget.
+    :param: maxPending: Maximum number of records waiting to be displayed.
+    :param: flushInterval: Interval (in ms) at which records are displayed.
     """
-    def __init__(self, textEdit):
+    def __init__(self, textEdit, maxBlocks=5000, maxPending=1000,
+                 flushInterval=100):
         logging.Handler.__init__(self)
         # format the output
         fmt = "%(asctime)s: %(levelname)s: %(name)s: %(message)s"
@@ -44,19 +57,94 @@ class QTextEditHandler(logging.Handler):
                             "WARNING" : "orange",
                             "ERROR" : "red",
                             "CRITICAL" : "red" }
+        self.charFormats = {}
         # configure the textEdit (most of the details are still handled in
         # EFrame_UI.py)
         self.textEdit = textEdit
         self.textEdit.setReadOnly(True)
+        self.textEdit.document().setMaximumBlockCount(maxBlocks)
+
+        # deque.append() and deque.popleft() are atomic, so no lock is
+        # needed between the logging threads and the GUI thread
+        self.records = collections.deque()
+        self.maxPending = maxPending
+        self.dropped = 0
+        self.droppedTotal = 0
+        self.droppedLock = threading.Lock()
+
+        self.timer = QtCore.QTimer(self.textEdit)
+        self.timer.timeout.connect(self.flushRecords)
+        self.timer.start(flushInterval)
 
     def emit(self, record):
-        color = self.fontColors[record.levelname]
-        charFormat = QtGui.QTextCharFormat()
-        charFormat.setForeground(QtGui.QBrush(QtGui.QColor(color)))
-        self.textEdit.setCurrentCharFormat(charFormat)
-        self.textEdit.append(self.format(record))
-        
-        
+        if len(self.records) >= self.maxPending:
+            with self.droppedLock:
+                self.dropped += 1
+                self.droppedTotal += 1
+            return
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.records.append((record.levelname, msg))
+
+    def stats(self):
+        """Return a dictionary with the handler's counters."""
+        return {"pending": len(self.records),
+                "dropped": self.droppedTotal}
+
+    def charFormat(self, levelname):
+        """Return the cached :class:`QTextCharFormat` for *levelname*."""
+        try:
+            return self.charFormats[levelname]
+        except KeyError:
+            color = self.fontColors.get(levelname, "black")
+            charFormat = QtGui.QTextCharFormat()
+            charFormat.setForeground(QtGui.QBrush(QtGui.QColor(color)))
+            self.charFormats[levelname] = charFormat
+            return charFormat
+
+    def flushRecords(self):
+        """Write all queued records to the widget (called on the GUI thread)."""
+        # group consecutive records of the same level into a single insert
+        runs = []
+        while True:
+            try:
+                levelname, msg = self.records.popleft()
+            except IndexError:
+                break
+            if runs and runs[-1][0] == levelname:
+                runs[-1][1].append(msg)
+            else:
+                runs.append((levelname, [msg]))
+
+        with self.droppedLock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            runs.append(("CRITICAL", ["%d log records dropped (%d in total)."
+                                      % (dropped, self.droppedTotal)]))
+
+        if not runs:
+            return
+
+        scrollBar = self.textEdit.verticalScrollBar()
+        atBottom = scrollBar.value() == scrollBar.maximum()
+
+        cursor = QtGui.QTextCursor(self.textEdit.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.beginEditBlock()
+        for levelname, messages in runs:
+            text = "\n".join(messages)
+            if not self.textEdit.document().isEmpty():
+                text = "\n" + text
+            cursor.insertText(text, self.charFormat(levelname))
+        cursor.endEditBlock()
+
+        if atBottom:
+            scrollBar.setValue(scrollBar.maximum())
+
+
 def _logMe():
     """Add log entries to test the handler."""
     logger.info("Solange Norwegen nicht untergeht,")